@@ -22,12 +22,16 @@ import logging
 import signal
 import sys
 import time
+from collections import OrderedDict
+from threading import Thread
 logging.basicConfig(stream=sys.stderr, level=logging.DEBUG, format='%(name)s (%(levelname)s): %(message)s')
 
 from urlparse import urlparse, parse_qs
 
 from .network.AvahiBrowser import AvahiBrowser
 from .network import Keyserver
+from .network.KeyFetcher import KeyFetcher, KeyPrefetcher
+from .network.DiscoveredServices import DiscoveredServices
 
 import gi
 gi.require_version('Gtk', '3.0')
@@ -50,6 +54,18 @@ except ImportError as e:
     print e
     import gpgmh
 
+try:
+    import keysign.gpgasync as gpgasync
+except ImportError as e:
+    print e
+    import gpgasync
+
+try:
+    from keysign.sigindex import SignatureIndex
+except ImportError as e:
+    print e
+    from sigindex import SignatureIndex
+
 
 Gst.init()
 
@@ -93,7 +109,7 @@ def format_listbox_key(key):
     result += format_uidslist(key.uidslist)
 
     if key.expiry:
-        result += ("\n<small>Expires {}</small>".format(date.fromtimestamp(float(key.expiry))))
+        result += ("\n<small>Expires {}</small>".format(key.expiry.date()))
     else:
         result += ("\n<small>No expiration date</small>")
     return result
@@ -109,11 +125,6 @@ def is_valid_fingerprint(fpr):
 
     return True
 
-def verify_downloaded_key(fpr, key):
-    # FIXME: will be replaced with code that checks if the fingerprint
-    # of the downloaded key is the same as the passed fpr
-    return key if fpr == key.fingerprint else None
-
 def format_fingerprint(fpr):
     res_fpr = ""
     for i in range(0, len(fpr), 4):
@@ -145,6 +156,11 @@ class ListBoxRowWithKey(Gtk.ListBoxRow):
 
 class Application(Gtk.Application):
 
+    # How often, and after how many seconds of not being reported by
+    # Avahi, discovered services are forgotten
+    service_expiry_interval = 60
+    service_max_age = 300
+
     __gsignals__ = {
         'fingerprint-validated': (GObject.SIGNAL_RUN_LAST, None,
                          # Hm, this is a str for now, but ideally
@@ -195,9 +211,26 @@ class Application(Gtk.Application):
         self.state = None
         self.last_state = None
         self.key = None
+        # The data of self.key as downloaded from the network
+        self.keydata = None
         self.timeout_id = 0
 
+        self.key_fetcher = KeyFetcher()
+        self.key_download = None
+
         self.keyserver = None
+        # The gpg runs for the key list and the key to be served
+        self.key_list_operation = None
+        self.export_operation = None
+
+        # Keys confirmed while collecting, to be signed in one go.
+        # Maps the fingerprint to a (key, keydata) tuple.
+        self.sign_queue = OrderedDict()
+        # Knows which keys we have signed already, see setup_signature_index
+        self.signature_index = None
+        # The fingerprints of the user's usable secret keys, as listed
+        # by update_key_list, so that we need not run gpg for them
+        self.own_fingerprints = []
 
     def do_startup(self):
         Gtk.Application.do_startup(self)
@@ -223,17 +256,24 @@ class Application(Gtk.Application):
         self.succes_fail_signing_label = self.builder.get_object("succes_fail_signing_label")
         # Update the key list with the user's own keys
         self.listbox = self.builder.get_object('keys_listbox')
-        keys = gpgmh.get_usable_secret_keys()
-        for key in keys:
-            self.listbox.add(ListBoxRowWithKey(key))
-
         self.listbox.connect('row-activated', self.on_row_activated, self.builder)
         self.listbox.connect('row-selected', self.on_row_selected, self.builder)
+        self.update_key_list()
+
+        thread = Thread(target=self.setup_signature_index)
+        thread.daemon = True
+        thread.start()
 
         self.avahi_browser = None
         self.avahi_service_type = '_keysign._tcp'
-        self.discovered_services = []
+        self.discovered_services = DiscoveredServices()
+        self.key_prefetcher = KeyPrefetcher(self.discovered_services)
         GLib.idle_add(self.setup_avahi_browser)
+        GLib.timeout_add_seconds(self.service_expiry_interval,
+                                 self.expire_discovered_services)
+        # The key-server is started without a key, so that
+        # presenting one only needs to announce it.
+        GLib.idle_add(self.start_keyserver)
 
         # Create menu action 'quit'
         action = Gio.SimpleAction.new('quit', None)
@@ -245,6 +285,26 @@ class Application(Gtk.Application):
         action.connect('activate', self.on_about)
         self.add_action(action)
 
+        # Create menu action 'collect-keys'.  While it is set,
+        # confirmed keys are queued instead of being signed right away.
+        action = Gio.SimpleAction.new_stateful('collect-keys', None,
+                                               GLib.Variant.new_boolean(False))
+        action.connect('change-state', self.on_collect_keys_changed)
+        self.add_action(action)
+
+        # Create menu action 'prefetch-keys'.  While it is set, the keys
+        # of the discovered services are downloaded in the background.
+        action = Gio.SimpleAction.new_stateful('prefetch-keys', None,
+                                               GLib.Variant.new_boolean(False))
+        action.connect('change-state', self.on_prefetch_keys_changed)
+        self.add_action(action)
+
+        # Create menu action 'sign-queued'
+        self.sign_queued_action = Gio.SimpleAction.new('sign-queued', None)
+        self.sign_queued_action.connect('activate', self.on_sign_queued)
+        self.sign_queued_action.set_enabled(False)
+        self.add_action(self.sign_queued_action)
+
         # Set up app menu
         self.set_app_menu(self.builder.get_object("app-menu"))
 
@@ -255,6 +315,29 @@ class Application(Gtk.Application):
         self.add_window(self.window)
         self.window.show_all()
 
+    def setup_signature_index(self):
+        """Opens the index of signatures and brings it up to date
+        with the user's keyring.  This runs in a separate thread,
+        because reading all signatures of a big keyring takes a while."""
+        try:
+            index = SignatureIndex()
+            index.refresh()
+        except Exception:
+            self.log.exception("Could not set up the signature index")
+        else:
+            GLib.idle_add(self.set_signature_index, index)
+
+    def set_signature_index(self, index):
+        self.signature_index = index
+        return False
+
+    def is_signed_already(self, key):
+        "Returns whether one of our secret keys has signed the key"
+        if self.signature_index is None:
+            return False
+        return self.signature_index.is_signed_by(key.fingerprint,
+                                                 self.own_fingerprints)
+
     def setup_avahi_browser(self):
         self.avahi_browser = AvahiBrowser(service=self.avahi_service_type)
         self.avahi_browser.connect('new_service', self.on_new_service)
@@ -263,7 +346,7 @@ class Application(Gtk.Application):
         return False
 
     def on_new_service(self, browser, name, address, port, txt_dict):
-        published_fpr = txt_dict.get('fingerprint', None)
+        published_fpr = txt_dict.fingerprint
 
         self.log.info("Probably discovered something, let's check; %s %s:%i:%s",
                         name, address, port, published_fpr)
@@ -286,30 +369,57 @@ class Application(Gtk.Application):
         return True
 
     def add_discovered_service(self, name, address, port, published_fpr):
-        self.discovered_services += ((name, address, port, published_fpr), )
-        #List needs to be modified when server services are removed.
-        self.log.info("Clients currently in list '%s'", self.discovered_services)
+        self.discovered_services.add(name, address, port, published_fpr)
+        self.log.info("%d clients currently known",
+                      len(self.discovered_services))
         return False
 
+    def expire_discovered_services(self):
+        '''Forgets the services Avahi has not reported for a while
+
+        Avahi tells us when a service goes away, but the removal may
+        get lost, e.g. when avahi-daemon restarts.  The services the
+        browser still reports are refreshed first, so they stay.'''
+        if self.avahi_browser is not None:
+            self.discovered_services.touch(self.avahi_browser.service_names())
+        expired = self.discovered_services.expire(self.service_max_age)
+        if expired:
+            self.log.info("Forgot %d stale services, %d clients currently known",
+                          len(expired), len(self.discovered_services))
+        return True
+
     def remove_discovered_service(self, name):
-        '''Removes server-side clients from discovered_services list
+        '''Removes server-side clients from discovered_services
         when the server name with fpr is a match.'''
-        for client in self.discovered_services:
-            if client[0] == name:
-                self.discovered_services.remove(client)
-        self.log.info("Clients currently in list '%s'", self.discovered_services)
+        self.discovered_services.remove(name)
+        self.log.info("%d clients currently known",
+                      len(self.discovered_services))
+        return False
 
 
     def update_key_list(self):
+        """Lists the user's keys without blocking the main loop.
+        The list is updated once gpg has finished."""
+        if self.key_list_operation is not None:
+            self.key_list_operation.cancel()
+        self.key_list_operation = gpgasync.get_usable_secret_keys_async(
+            self.on_key_list_loaded, self.on_key_list_error)
+
+    def on_key_list_loaded(self, keys):
+        self.key_list_operation = None
+        self.own_fingerprints = [key.fingerprint for key in keys]
         #FIXME do not remove rows, but update data
         for listrow in self.listbox:
             self.listbox.remove(listrow)
 
-        keys = gpgmh.get_usable_secret_keys()
         for key in keys:
             self.listbox.add(ListBoxRowWithKey(key))
         self.listbox.show_all()
 
+    def on_key_list_error(self, error):
+        self.key_list_operation = None
+        self.log.error("Could not list the keys: %s", error)
+
     def sign_key(self, key, uids):
         self.succes_fail_signing_label.set_markup("Key succesfully signed!")
         self.succes_fail_signing_label.show()
@@ -338,10 +448,10 @@ class Application(Gtk.Application):
         self.last_state = self.state
 
         if self.last_state == DOWNLOAD_KEY_STATE:
-            # Reset download timer
-            if self.timeout_id != 0:
-                GLib.source_remove(self.timeout_id)
-                self.timeout_id = 0
+            # Stop downloading
+            if self.key_download is not None:
+                self.key_download.cancel()
+                self.key_download = None
         elif self.last_state == PRESENT_KEY_STATE:
             # Shutdown key server
             if self.keyserver:
@@ -417,40 +527,39 @@ class Application(Gtk.Application):
         self.update_back_refresh_button_icon()
 
 
-    def download_keys(self, fpr=None):
-        # FIXME: this will be replaced with code that downloads
-        # data from network
-        if not fpr:
-            return gpgmh.get_usable_secret_keys()
-        else:
-            res = []
-            keys = gpgmh.get_usable_secret_keys()
-            for key in keys:
-                if key.fingerprint == fpr:
-                    res.append(key)
-        return res
-
     def obtain_key_async(self, cleaned_fpr, callback, error_cb):
+        """Downloads the key from the discovered services in the
+        background.  Calls callback with the key or error_cb
+        from the main loop."""
         self.log.debug("Obtaining key with fpr: {}".format(cleaned_fpr))
 
         # ToBeNoted(TBN): An attacker can publish a network service with the
         # same fingerprint in it's TXT record as another participant. This is
         # why we download all data from the network and verify it afterwards.
-        keys = self.download_keys(cleaned_fpr)
-        key = None
+        def on_key_downloaded(key, keydata):
+            self.key_download = None
+            self.key = key
+            self.keydata = keydata
+            callback(key)
 
-        for keydata in keys:
-            key = verify_downloaded_key(cleaned_fpr, keydata)
-            if key:
-                break
+        def on_download_failed():
+            self.key_download = None
+            error_cb()
 
-        if key:
-            self.key = key
-            GLib.idle_add(callback, key)
-        else:
-            GLib.idle_add(error_cb)
+        if self.key_download is not None:
+            self.key_download.cancel()
+            self.key_download = None
 
-        return False
+        prefetched = self.key_prefetcher.lookup(cleaned_fpr)
+        if prefetched is not None:
+            self.log.debug("Using the prefetched key")
+            on_key_downloaded(*prefetched)
+            return
+
+        self.key_download = self.key_fetcher.fetch(cleaned_fpr,
+                                                   self.discovered_services,
+                                                   on_key_downloaded,
+                                                   on_download_failed)
 
     def on_valid_fingerprint(self, app, cleaned_fpr):
         self.error_download_label.hide()
@@ -460,27 +569,24 @@ class Application(Gtk.Application):
         self.update_app_state(DOWNLOAD_KEY_STATE)
         self.update_back_refresh_button_icon()
 
-        # GLib.idle_add(self.obtain_key_async, cleaned_fpr)
-        download_time = 3
-        self.timeout_id = GLib.timeout_add_seconds(download_time,
-                                                    self.obtain_key_async,
-                                                    cleaned_fpr,
-                                                    self.received_key_callback,
-                                                    self.invalid_key_callback,
-                                                    priority=GLib.PRIORITY_DEFAULT)
+        self.obtain_key_async(cleaned_fpr,
+                              self.received_key_callback,
+                              self.invalid_key_callback)
 
     def received_key_callback(self, key):
         self.log.debug("Called received_key_callback")
 
         self.spinner1.stop()
         keyIdsLabel = self.builder.get_object("key_ids_label")
-        keyIdsLabel.set_markup(format_key_header(key.fingerprint))
+        key_header = format_key_header(key.fingerprint)
+        if self.is_signed_already(key):
+            key_header += "\n<small>You have signed this key already</small>"
+        keyIdsLabel.set_markup(key_header)
 
         uidsLabel = self.builder.get_object("uids_label")
         markup = format_uidslist(key.uidslist)
         uidsLabel.set_markup(markup)
 
-        self.timeout_id = 0
         self.receive_stack.set_visible_child_name('page2')
         self.update_app_state(CONFIRM_KEY_STATE)
         self.update_back_refresh_button_icon()
@@ -584,44 +690,88 @@ class Application(Gtk.Application):
         qr_frame.show_all()
 
         self.log.debug("Keyserver switched on! Serving key with fpr: %s", fpr)
-        # GLib.idle_add(self.setup_server(keydata, fpr))
-        self.setup_server(key, key.fingerprint)
+        # The key is served once gpg has exported it
+        if self.export_operation is not None:
+            self.export_operation.cancel()
+        self.export_operation = gpgasync.get_public_key_data_async(
+            key.fingerprint,
+            lambda keydata: self.on_key_exported(keydata, key.fingerprint),
+            self.on_key_export_error)
 
         self.send_stack.set_visible_child_name('page1')
         self.update_app_state(PRESENT_KEY_STATE)
         self.update_back_refresh_button_icon()
 
+    def on_key_exported(self, keydata, fingerprint):
+        self.export_operation = None
+        # The user might have gone back while gpg was exporting
+        if self.get_app_state() == PRESENT_KEY_STATE:
+            self.setup_server(keydata, fingerprint)
+
+    def on_key_export_error(self, error):
+        self.export_operation = None
+        self.log.error("Could not export the key to serve: %s", error)
+
     def on_row_selected(self, listBoxObject, listBoxRowObject, builder, *args):
         self.log.debug("ListRow selected!Key:\n '{}'\n selected".format(listBoxRowObject.key))
 
+    def start_keyserver(self):
+        """Starts the key-server, which serves no key yet.
+        It is tried again with the next key if it fails to start."""
+        if self.keyserver is None:
+            self.log.debug('About to call %r', Keyserver.ServeKeyThread)
+            keyserver = Keyserver.ServeKeyThread()
+            self.log.info('Starting thread %r', keyserver)
+            try:
+                keyserver.start()
+            except Exception:
+                self.log.exception('Could not start the key-server')
+            else:
+                self.keyserver = keyserver
+        return False
+
     def setup_server(self, keydata, fingerprint):
         """
-        Starts the key-server which serves the provided keydata and
+        Serves the provided keydata with the key-server and
         announces the fingerprint as TXT record using Avahi
+
+        The key-server is started once and then reused
+        for the other keys the user presents.
         """
         self.log.info('Serving now')
-        self.log.debug('About to call %r', Keyserver.ServeKeyThread)
-        self.keyserver = Keyserver.ServeKeyThread(str(keydata), fingerprint)
-        self.log.info('Starting thread %r', self.keyserver)
-        self.keyserver.start()
+        self.start_keyserver()
+        if self.keyserver is None:
+            self.log.error("Cannot serve the key %s", fingerprint)
+            return False
+        self.keyserver.add_key(str(keydata), fingerprint)
         self.log.info('Finished serving')
         return False
 
     def stop_server(self):
-        self.keyserver.shutdown()
+        """Stops serving and announcing the keys.
+        The key-server keeps running for the next key."""
+        for fingerprint in self.keyserver.fingerprints():
+            self.keyserver.remove_key(fingerprint)
 
     def on_cancel_download_button_clicked(self, buttonObject, *args):
         self.log.debug("Cancel download button clicked.")
-        if self.timeout_id != 0:
-            GLib.source_remove(self.timeout_id)
+        if self.key_download is not None:
+            self.key_download.cancel()
+            self.key_download = None
             self.error_download_label.show()
-            self.timeout_id = 0
 
         self.spinner1.stop()
 
     def on_confirm_button_clicked(self, buttonObject, *args):
         self.log.debug("Confirm sign button clicked.")
 
+        if self.is_collecting_keys():
+            self.queue_key(self.key, self.keydata)
+            self.receive_stack.set_visible_child_name('page0')
+            self.update_app_state(ENTER_FPR_STATE)
+            self.update_back_refresh_button_icon()
+            return
+
         self.succes_fail_signing_label.hide()
         self.spinner2.start()
 
@@ -633,6 +783,107 @@ class Application(Gtk.Application):
         uids_to_sign = self.key.uidslist
         self.emit('sign-key-confirmed', self.key, uids_to_sign)
 
+    def is_collecting_keys(self):
+        return self.lookup_action('collect-keys').get_state().get_boolean()
+
+    def on_collect_keys_changed(self, action, value):
+        action.set_state(value)
+        self.log.debug("Collecting keys for signing later: %s",
+                       value.get_boolean())
+
+    def on_prefetch_keys_changed(self, action, value):
+        action.set_state(value)
+        self.log.debug("Prefetching keys: %s", value.get_boolean())
+        self.key_prefetcher.set_enabled(value.get_boolean())
+
+    def queue_key(self, key, keydata):
+        '''Adds a confirmed key to the queue of keys to be signed
+        with the 'sign-queued' action'''
+        self.sign_queue[key.fingerprint] = (key, keydata)
+        self.sign_queued_action.set_enabled(True)
+        self.log.info("Queued key %s, %d keys in queue",
+                      key.fingerprint, len(self.sign_queue))
+
+    def on_sign_queued(self, action, param):
+        '''Signs all queued keys in one batch
+
+        This happens in a separate thread, because signing
+        many keys takes a while.'''
+        queued = list(self.sign_queue.values())
+        self.sign_queue.clear()
+        self.sign_queued_action.set_enabled(False)
+
+        # There is no point in signing a key again
+        skipped = [key for key, keydata in queued if self.is_signed_already(key)]
+        if skipped:
+            self.log.info("Skipping keys signed already: %s",
+                          [key.fingerprint for key in skipped])
+            queued = [(key, keydata) for key, keydata in queued
+                      if key not in skipped]
+
+        uids_signed_label = self.builder.get_object("uids_signed_label")
+        uids_signed_label.set_markup(''.join(format_uidslist(key.uidslist)
+                                             for key, keydata in queued))
+        self.stack.set_visible_child(self.receive_stack)
+        self.receive_stack.set_visible_child_name('page3')
+        self.update_app_state(SIGN_KEY_STATE)
+        self.update_back_refresh_button_icon()
+
+        if not queued:
+            self.succes_fail_signing_label.set_markup(
+                "All queued keys are signed already")
+            self.succes_fail_signing_label.show()
+            return
+
+        self.log.info("Signing %d queued keys", len(queued))
+        self.succes_fail_signing_label.hide()
+        self.spinner2.start()
+
+        keydatas = [keydata for key, keydata in queued]
+        thread = Thread(target=self.sign_keydatas, args=(keydatas,))
+        thread.daemon = True
+        thread.start()
+
+    def sign_keydatas(self, keydatas):
+        "Runs in a separate thread and reports back to the main loop"
+        # Maps the fingerprints of the signed keys to those of our
+        # secret keys which have signed them
+        signers = {}
+        try:
+            results = list(gpgmh.sign_keydatas_and_encrypt(keydatas,
+                                                           signers=signers))
+        except Exception:
+            self.log.exception("Signing the queued keys failed")
+            results = None
+        GLib.idle_add(self.on_queued_keys_signed, len(keydatas), results,
+                      signers)
+
+    def on_queued_keys_signed(self, nkeys, results, signers):
+        self.spinner2.stop()
+        if results is None:
+            self.succes_fail_signing_label.set_markup("Key signing failed!")
+        else:
+            nsigned = len(set(fpr for fpr, uid, encrypted in results))
+            self.log.info("Signed %d of %d keys (%d UIDs)",
+                          nsigned, nkeys, len(results))
+            self.remember_signatures(results, signers)
+            self.succes_fail_signing_label.set_markup(
+                "{} of {} keys succesfully signed!".format(nsigned, nkeys))
+        self.succes_fail_signing_label.show()
+        return False
+
+    def remember_signatures(self, results, signers):
+        """Records our signatures in the signature index
+
+        They are sent to the key owners rather than imported into
+        the user's keyring, so we would not learn about them otherwise.
+        Only the secret keys which have signed a key are recorded."""
+        if self.signature_index is None:
+            return
+        self.signature_index.add((signer[-16:], fpr, uid, None)
+                                 for fpr, uid, encrypted in results
+                                 for signer in signers.get(fpr, ()))
+
     def on_cancel_signing_button_clicked(self, buttonObject, *args):
         self.log.debug("Cancel signing button clicked.")
         if self.timeout_id != 0:
@@ -653,6 +904,10 @@ class Application(Gtk.Application):
         self.on_quit(self)
 
     def do_shutdown(self):
+        if self.keyserver:
+            self.keyserver.shutdown()
+        self.key_fetcher.close()
+        self.key_prefetcher.close()
         Gtk.Application.do_shutdown(self)
 
     def on_about(self, action, param):
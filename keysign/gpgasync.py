@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+#    Copyright 2016 Tobias Mueller <muelli@cryptobitch.de>
+#
+#    This file is part of GNOME Keysign.
+#
+#    GNOME Keysign is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    GNOME Keysign is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with GNOME Keysign.  If not, see <http://www.gnu.org/licenses/>.
+"""Runs gpg without blocking the GLib main loop
+
+The functions in gpgmh block until gpg has finished, which, for
+a keyring with thousands of keys, takes long enough to freeze the UI.
+The functions here start gpg as a Gio.Subprocess and return
+a GpgOperation right away.  Once gpg has finished, the result is
+passed to a callback from the main loop.  The output is parsed with
+the same code as in gpgmh, so the results are the same.
+"""
+import logging
+
+from gi.repository import Gio, GLib
+
+from monkeysign.gpg import GpgRuntimeError
+
+try:
+    from . import gpgmh
+except (ImportError, ValueError):
+    # We are not imported as part of the keysign package
+    import gpgmh
+
+log = logging.getLogger(__name__)
+
+
+SUBPROCESS_FLAGS = (Gio.SubprocessFlags.STDIN_PIPE
+                    | Gio.SubprocessFlags.STDOUT_PIPE
+                    | Gio.SubprocessFlags.STDERR_PIPE)
+
+
+def _text(data):
+    "Returns gpg's output as native str"
+    if str is not bytes:
+        return data.decode('utf-8', 'replace')
+    return data
+
+
+def _lines(data):
+    return _text(data).splitlines()
+
+
+class GpgOperation(object):
+    '''A gpg command which runs while the main loop carries on
+
+    When gpg has finished, its output is passed through parse and the
+    result is handed to the callback.  If gpg cannot be run, returns
+    non-zero (and check is set), or parse fails, the exception is
+    handed to error_cb instead.  Both are called from the main loop
+    and at most one of them is called, never if the operation has
+    been cancelled.  Afterwards, the result or exception is
+    available as the result or error attribute.
+
+    An operation may start a followup operation from its callback,
+    which is then cancelled together with it.
+    '''
+    def __init__(self, argv, callback, error_cb=None, parse=None,
+                 stdin=None, check=True):
+        self.argv = argv
+        self.callback = callback
+        self.error_cb = error_cb
+        self.parse = parse
+        self.stdin = stdin
+        self.check = check
+
+        self.cancellable = Gio.Cancellable()
+        self.followup = None
+        self.cancelled = False
+        self.done = False
+        self.result = None
+        self.error = None
+        self._proc = None
+
+    @classmethod
+    def resolved(cls, result, callback):
+        '''Returns an operation which hands an already known result
+        to the callback, as soon as the main loop gets to it'''
+        operation = cls(None, callback)
+        GLib.idle_add(operation._succeed, result)
+        return operation
+
+    def start(self):
+        log.debug('Starting %s', ' '.join(self.argv))
+        try:
+            self._proc = Gio.Subprocess.new(self.argv, SUBPROCESS_FLAGS)
+        except GLib.Error as e:
+            # Failing from the main loop, too, so that the caller
+            # does not get called back before we have returned
+            GLib.idle_add(self._fail, e)
+            return self
+
+        stdin = GLib.Bytes.new(self.stdin) if self.stdin is not None else None
+        self._proc.communicate_async(stdin, self.cancellable,
+                                     self._on_communicated, None)
+        return self
+
+    def cancel(self):
+        "Stops gpg, if it still runs, and forgets about the result"
+        self.cancelled = True
+        self.cancellable.cancel()
+        if self._proc is not None and not self.done:
+            self._proc.force_exit()
+        if self.followup is not None:
+            self.followup.cancel()
+
+    def _on_communicated(self, proc, result, user_data):
+        if self.cancelled:
+            return
+        try:
+            success, stdout, stderr = proc.communicate_finish(result)
+        except GLib.Error as e:
+            self._fail(e)
+            return
+
+        stdout = stdout.get_data() if stdout is not None else b''
+        if self.check and not proc.get_successful():
+            stderr = stderr.get_data() if stderr is not None else b''
+            self._fail(GpgRuntimeError(proc.get_exit_status(),
+                                       _text(stderr)))
+            return
+
+        try:
+            value = self.parse(stdout) if self.parse else stdout
+        except Exception as e:
+            log.exception('Could not parse the output of %s', self.argv)
+            self._fail(e)
+            return
+        self._succeed(value)
+
+    def _succeed(self, result):
+        if not self.cancelled and not self.done:
+            self.done = True
+            self.result = result
+            self.callback(result)
+        return False
+
+    def _fail(self, error):
+        if not self.cancelled and not self.done:
+            self.done = True
+            self.error = error
+            log.info('%s failed: %s', self.argv, error)
+            if self.error_cb:
+                self.error_cb(error)
+        return False
+
+
+def build_command(command, keyring=None, options=()):
+    '''Returns the argv to run a gpg command with the options
+    of the keyring, i.e. of the user's keyring by default
+
+    Additional options may be given as (name, value) tuples.'''
+    if keyring is None:
+        with gpgmh.keyring_pool.keyring() as keyring:
+            return build_command(command, keyring, options)
+    saved_options = dict(keyring.context.options)
+    try:
+        for name, value in options:
+            keyring.context.set_option(name, value)
+        return keyring.context.build_command(command)
+    finally:
+        keyring.context.options = saved_options
+
+
+def run_command_async(command, callback, error_cb=None, parse=None,
+                      stdin=None, check=True, keyring=None, options=()):
+    '''Runs a gpg command, e.g. ['list-keys'], and returns
+    the started GpgOperation.  See GpgOperation for the arguments.'''
+    argv = build_command(command, keyring, options)
+    return GpgOperation(argv, callback, error_cb, parse, stdin, check).start()
+
+
+def list_keys_async(callback, error_cb=None, pattern=None, secret=False,
+                    predicate=None, keyring=None):
+    '''Lists the (secret) keys like gpgmh.list_keys and hands
+    the resulting KeyTable to the callback'''
+    command = ['list-secret-keys' if secret else 'list-keys']
+    if pattern:
+        command.append(pattern)
+    def parse(output):
+        records = gpgmh.iter_colon_records(_lines(output),
+                                           types=('pub', 'sec', 'fpr', 'uid'))
+        return gpgmh.KeyTable.from_records(records, predicate)
+    return run_command_async(command, callback, error_cb, parse,
+                             keyring=keyring)
+
+
+def get_usable_secret_keys_async(callback, error_cb=None, pattern=None):
+    '''Hands the list of usable secret keys of the user's keyring
+    to the callback, like gpgmh.get_usable_secret_keys
+
+    The result shares the cache with gpgmh.get_usable_secret_keys, so
+    gpg is only run if the keyring has changed, and the blocking
+    function does not need to run gpg after this one has finished.'''
+    cache_key = ('usable_secret_keys', pattern)
+    # Taken before running gpg, see KeyringSnapshotCache.get
+    stamp = gpgmh.keyring_cache.stamp()
+    keys = gpgmh.keyring_cache.lookup(cache_key, stamp)
+    if keys is not gpgmh.NOT_CACHED:
+        return GpgOperation.resolved(list(keys), callback)
+
+    def finish(keys):
+        log.info('Returning usable private keys: %s', keys)
+        gpgmh.keyring_cache.store(cache_key, stamp, keys)
+        callback(list(keys))
+
+    def on_secret_keys(secret_keys):
+        fingerprints = secret_keys.fingerprints
+        log.debug('Detected secret keys: %s', fingerprints)
+        if not fingerprints:
+            finish([])
+            return
+
+        def parse(output):
+            records = gpgmh.iter_colon_records(_lines(output),
+                                               types=('pub', 'fpr'))
+            return gpgmh.usable_fingerprints_from_records(records,
+                                                          fingerprints)
+        def on_usable_fingerprints(usable):
+            finish([secret_keys.get(fpr)
+                    for fpr in fingerprints if fpr in usable])
+
+        # gpg returns non-zero if one of the patterns cannot be found,
+        # but it lists all the others nonetheless.
+        operation.followup = run_command_async(['list-keys'] + fingerprints,
+                                               on_usable_fingerprints,
+                                               error_cb, parse, check=False)
+
+    operation = list_keys_async(on_secret_keys, error_cb, pattern,
+                                secret=True)
+    return operation
+
+
+def get_public_key_data_async(fpr, callback, error_cb=None, keyring=None):
+    '''Hands the armored key data to the callback,
+    like gpgmh.get_public_key_data'''
+    return run_command_async(['export', fpr], callback, error_cb, _text,
+                             keyring=keyring, options=[('armor', None)])
+
+
+def signatures_for_keyid_async(keyid, callback, error_cb=None, keyring=None):
+    '''Hands the list of (keyid, timestamp, uid) tuples of the signatures
+    on the key to the callback, like gpgmh.signatures_for_keyid'''
+    def parse(output):
+        return list(gpgmh.iter_sigs(_lines(output)))
+    return run_command_async(['list-sigs', keyid], callback, error_cb, parse,
+                             keyring=keyring)
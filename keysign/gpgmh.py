@@ -16,14 +16,33 @@
 #    You should have received a copy of the GNU General Public License
 #    along with GNOME Keysign.  If not, see <http://www.gnu.org/licenses/>.
 
-from collections import namedtuple
+import atexit
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
+import hashlib
 import logging
-from tempfile import NamedTemporaryFile
+from multiprocessing.pool import ThreadPool
+import os
+import subprocess
+from shutil import copyfile, rmtree
+from tempfile import mkdtemp, TemporaryFile
+import threading
 import warnings
 
+try:
+    from queue import Queue, Empty
+except ImportError:
+    from Queue import Queue, Empty
+
 from monkeysign.gpg import Keyring
-from monkeysign.gpg import GpgRuntimeError
+from monkeysign.gpg import GpgProtocolError, GpgRuntimeError
+
+try:
+    from . import openpgp
+except (ImportError, ValueError):
+    # We are not imported as part of the keysign package
+    import openpgp
 
 
 # FIXME: This probably wants to go somewhere more central.
@@ -31,23 +50,205 @@ from monkeysign.gpg import GpgRuntimeError
 log = logging.getLogger(__name__)
 
 
+_agent_launched = False
+
+def launch_agent():
+    '''Starts the gpg-agent ahead of time
+
+    gpg2 spawns the agent lazily on the first command which needs it,
+    so the first signing or export would pay for the agent's startup.
+    We ask gpgconf to launch it once per process.
+    gpg1.4 does not have gpgconf, which is fine, because it does not
+    need the agent for the operations we perform.'''
+    global _agent_launched
+    if _agent_launched:
+        return
+    _agent_launched = True
+    try:
+        with open(os.devnull, 'wb') as devnull:
+            ret = subprocess.call(['gpgconf', '--launch', 'gpg-agent'],
+                                  stdout=devnull, stderr=devnull)
+        log.debug('gpgconf --launch gpg-agent returned %s', ret)
+    except OSError as e:
+        log.debug('Could not launch gpg-agent: %s', e)
+
+
+class KeyringPool(object):
+    '''A bounded pool of long-lived Keyrings for the user's keyring
+
+    A monkeysign Keyring keeps the output of the last command in its
+    Context, so a Keyring must not be used by two threads at once.
+    Instead of creating a fresh Keyring for every call, we hand out
+    Keyrings from this pool for the duration of a with-block:
+
+        with keyring_pool.keyring() as keyring:
+            keyring.export_data(fpr)
+
+    GnuPG does not have a mode in which one process serves several
+    commands, so each command is still one gpg run.  But the pooled
+    Keyrings share a warm gpg-agent and do not make gpg check the
+    trustdb on every invocation, which is what makes a cold gpg slow.
+    The options of a Keyring are restored when it is returned, so
+    callers may set options on the Keyring they have been handed.
+    '''
+    def __init__(self, size=4, factory=None):
+        self.size = size
+        self.factory = factory or Keyring
+        self._idle = Queue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _new_keyring(self):
+        launch_agent()
+        keyring = self.factory()
+        # We only list, export, and verify with these keyrings.
+        # The trust values are not needed for that.
+        keyring.context.set_option('no-auto-check-trustdb')
+        keyring._pool_options = dict(keyring.context.options)
+        log.debug('Created pooled keyring %r (%d/%d)',
+                  keyring, self._created, self.size)
+        return keyring
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except Empty:
+            pass
+        with self._lock:
+            create = self._created < self.size
+            if create:
+                self._created += 1
+        if create:
+            return self._new_keyring()
+        # All Keyrings are in use, so we wait for one to be returned
+        return self._idle.get()
+
+    def _release(self, keyring):
+        keyring.context.options = dict(keyring._pool_options)
+        self._idle.put(keyring)
+
+    @contextmanager
+    def keyring(self):
+        "Lends a Keyring for the user's regular keyring"
+        keyring = self._acquire()
+        try:
+            yield keyring
+        finally:
+            self._release(keyring)
+
+
+# The pool used whenever a function is not given a keyring explicitly
+keyring_pool = KeyringPool()
+
+
+# The files in GnuPG's home directory whose change means that what we
+# have learned from the user's keyring may be outdated.  gpg1 and gpg2
+# use different files, so we look at all of them.
+KEYRING_FILES = ('pubring.kbx', 'pubring.gpg', 'secring.gpg',
+                 'trustdb.gpg', 'private-keys-v1.d')
+
+def gnupg_homedir():
+    "Returns the directory GnuPG uses for the user's regular keyring"
+    return os.environ.get('GNUPGHOME') or os.path.expanduser('~/.gnupg')
+
+
+def keyring_stamp(homedir=None):
+    '''Returns a value which changes whenever the user's keyring changes
+
+    It is made of the mtime, size, and inode of the keyring files.
+    GnuPG replaces the keyring with a new file when it modifies it,
+    so the inode changes even if mtime and size happen to stay the same.'''
+    homedir = homedir or gnupg_homedir()
+    stamp = []
+    for fname in KEYRING_FILES:
+        try:
+            st = os.stat(os.path.join(homedir, fname))
+        except OSError:
+            stamp.append(None)
+        else:
+            stamp.append((st.st_mtime, st.st_size, st.st_ino))
+    return tuple(stamp)
+
+
+# Returned by KeyringSnapshotCache.lookup if there is no valid value
+NOT_CACHED = object()
+
+class KeyringSnapshotCache(object):
+    '''Remembers what has been read from the user's keyring
+
+    Values are stored together with the keyring_stamp which was valid
+    when they were computed.  They are handed out until the stamp
+    changes, i.e. until the keyring files have been modified.
+    Checking the stamp costs a couple of stat calls instead of gpg runs.
+    '''
+    def __init__(self, homedir=None):
+        self.homedir = homedir
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, compute):
+        '''Returns the cached value for key or stores the result
+        of calling compute if the keyring has changed since'''
+        # We take the stamp before computing, so that a modification
+        # which happens while we call gpg invalidates the result.
+        stamp = self.stamp()
+        value = self.lookup(key, stamp)
+        if value is not NOT_CACHED:
+            return value
+
+        value = compute()
+        self.store(key, stamp, value)
+        return value
+
+    def stamp(self):
+        "Returns the current keyring_stamp"
+        return keyring_stamp(self.homedir)
+
+    def lookup(self, key, stamp=None):
+        '''Returns the cached value for key if it was computed
+        with the given (or the current) stamp, NOT_CACHED otherwise'''
+        if stamp is None:
+            stamp = self.stamp()
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None and entry[0] == stamp:
+            log.debug('Keyring unchanged, using cached %r', key)
+            return entry[1]
+        return NOT_CACHED
+
+    def store(self, key, stamp, value):
+        '''Stores a value computed with the stamp taken before
+        the computation started'''
+        with self._lock:
+            self._entries[key] = (stamp, value)
+
+    def invalidate(self):
+        "Forgets all cached values"
+        with self._lock:
+            self._entries.clear()
+
+
+# Caches the results for the user's keyring, i.e. when no keyring is given
+keyring_cache = KeyringSnapshotCache()
+
+
 def UIDExport(uid, keydata):
     """Export only the UID of a key.
     Unfortunately, GnuPG does not provide smth like
     --export-uid-only in order to obtain a UID and its
     signatures."""
-    tmp = TempKeyring()
-    # Hm, apparently this needs to be set, otherwise gnupg will issue
-    # a stray "gpg: checking the trustdb" which confuses the gnupg library
-    tmp.context.set_option('always-trust')
-    tmp.import_data(keydata)
-    for fpr, key in tmp.get_keys(uid).items():
-        for u in key.uidslist:
-            key_uid = u.uid
-            if key_uid != uid:
-                log.info('Deleting UID %s from key %s', key_uid, fpr)
-                tmp.del_uid(fingerprint=fpr, pattern=key_uid)
-    only_uid = tmp.export_data(uid)
+    with scratch_pool.keyring() as tmp:
+        # Hm, apparently this needs to be set, otherwise gnupg will issue
+        # a stray "gpg: checking the trustdb" which confuses the gnupg library
+        tmp.context.set_option('always-trust')
+        tmp.import_data(keydata)
+        for fpr, key in tmp.get_keys(uid).items():
+            for u in key.uidslist:
+                key_uid = u.uid
+                if key_uid != uid:
+                    log.info('Deleting UID %s from key %s', key_uid, fpr)
+                    tmp.del_uid(fingerprint=fpr, pattern=key_uid)
+        only_uid = tmp.export_data(uid)
 
     return only_uid
 
@@ -55,18 +256,27 @@ def UIDExport(uid, keydata):
 def MinimalExport(keydata):
     '''Returns the minimised version of a key
 
-    For now, you must provide one key only.'''
-    tmpkeyring = TempKeyring()
-    ret = tmpkeyring.import_data(keydata)
-    log.debug("Returned %s after importing %r", ret, keydata)
-    assert ret
-    tmpkeyring.context.set_option('export-options', 'export-minimal')
-    keys_dict = tmpkeyring.get_keys()
-    # We assume the keydata to contain one key only
-    keys = list(keys_dict.items())
-    log.debug("Keys after importing: %s (%s)", keys, keys)
-    fingerprint, key = keys[0]
-    stripped_key = tmpkeyring.export_data(fingerprint)
+    For now, you must provide one key only.
+
+    The third party signatures are stripped in-process.  Only if the
+    data cannot be parsed, e.g. because of an unsupported key version,
+    we let gpg do it.'''
+    try:
+        return openpgp.minimize(keydata)
+    except openpgp.PacketError as e:
+        log.info('Cannot minimise natively, using gpg: %s', e)
+
+    with scratch_pool.keyring() as tmpkeyring:
+        ret = tmpkeyring.import_data(keydata)
+        log.debug("Returned %s after importing %r", ret, keydata)
+        assert ret
+        tmpkeyring.context.set_option('export-options', 'export-minimal')
+        keys_dict = tmpkeyring.get_keys()
+        # We assume the keydata to contain one key only
+        keys = list(keys_dict.items())
+        log.debug("Keys after importing: %s (%s)", keys, keys)
+        fingerprint, key = keys[0]
+        stripped_key = tmpkeyring.export_data(fingerprint)
     return stripped_key
 
 
@@ -82,25 +292,39 @@ class SplitKeyring(Keyring):
         self.context.set_option('no-default-keyring')
 
 
+def scratch_dir():
+    '''Returns the directory in which temporary keyrings are created
+
+    We prefer /dev/shm, because it is a tmpfs on most Linux systems,
+    so the many short-lived keyring files never hit the disk.
+    None means the default temporary directory.'''
+    shm = '/dev/shm'
+    if os.path.isdir(shm) and os.access(shm, os.W_OK | os.X_OK):
+        return shm
+    return None
+
+
 class TempKeyring(SplitKeyring):
     """A temporary keyring which will be discarded after use
 
-    It creates a temporary file which will be used for a SplitKeyring.
+    It creates a temporary directory holding the files for a SplitKeyring.
     You may not necessarily be able to use this Keyring as is, because
     gpg1.4 does not like using secret keys which is does not have the
     public keys of in its pubkeyring.
 
     So you may not necessarily be able to perform operations with
     the user's secret keys (like creating signatures).
+
+    The keyring can be emptied with reset() in order to be reused
+    and its files are removed with close().
     """
     def __init__(self, *args, **kwargs):
-        # A NamedTemporaryFile deletes the backing file
-        self.kr_tempfile = NamedTemporaryFile(prefix='gpgpy-')
-        self.kr_fname = self.kr_tempfile.name
-        self.tdb_tempfile = NamedTemporaryFile(prefix='gpgpy-tdb-',
-                                               delete=True)
-        self.tdb_fname = self.tdb_tempfile.name
-        # This should delete the file.
+        # All the files, including the trustdb and the backups and
+        # locks gpg creates next to the keyring, live in this directory.
+        self.tempdir = mkdtemp(prefix='gpgpy-', dir=scratch_dir())
+        self.kr_fname = os.path.join(self.tempdir, 'pubring.gpg')
+        open(self.kr_fname, 'wb').close()
+        # We only name the trustdb, but do not create the file.
         # Why are we doing it?  Well...
         # Turns out that if you run gpg --trustdb-name with an
         # empty file, it complains about an invalid trustdb.
@@ -108,12 +332,88 @@ class TempKeyring(SplitKeyring):
         # it'll happily create a new trustdb.
         # FWIW: Am empty trustdb file seems to be 40 bytes long,
         # but the contents seems to be non-deterministic.
-        # Anyway, we'll leak the file :-/
-        self.tdb_tempfile.close()
+        self.tdb_fname = os.path.join(self.tempdir, 'trustdb.gpg')
 
         SplitKeyring.__init__(self, primary_keyring_fname=self.kr_fname,
                                     trustdb_fname=self.tdb_fname,
                                     *args, **kwargs)
+        self._initial_options = dict(self.context.options)
+
+    def reset(self):
+        """Empties the keyring and restores the initial options
+
+        The keyring file is truncated and everything else gpg has
+        created, e.g. the trustdb, is removed."""
+        kr_basename = os.path.basename(self.kr_fname)
+        for fname in os.listdir(self.tempdir):
+            if fname != kr_basename:
+                os.unlink(os.path.join(self.tempdir, fname))
+        open(self.kr_fname, 'wb').close()
+        self.context.options = dict(self._initial_options)
+
+    def close(self):
+        "Removes the files of this keyring"
+        tempdir = getattr(self, 'tempdir', None)
+        if tempdir is not None:
+            rmtree(tempdir, ignore_errors=True)
+            self.tempdir = None
+
+    def __del__(self):
+        self.close()
+
+
+class ScratchKeyringPool(object):
+    '''Keeps TempKeyrings around for reuse
+
+    Creating a TempKeyring means creating a directory and files, and
+    making gpg set up a new trustdb.  Operations like UIDExport only
+    need a keyring for a moment, so they borrow one from this pool:
+
+        with scratch_pool.keyring() as tmp:
+            tmp.import_data(keydata)
+
+    Returned keyrings are reset, so the next user gets an empty
+    keyring with the default options.  At most size keyrings are
+    kept; surplus ones are closed.
+    '''
+    def __init__(self, size=4):
+        self.size = size
+        self._idle = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def keyring(self):
+        "Lends an empty TempKeyring"
+        with self._lock:
+            keyring = self._idle.pop() if self._idle else None
+        if keyring is None:
+            keyring = TempKeyring()
+        try:
+            yield keyring
+        finally:
+            self._release(keyring)
+
+    def _release(self, keyring):
+        try:
+            keyring.reset()
+        except (IOError, OSError) as e:
+            log.warning('Could not reset %r, discarding it: %s', keyring, e)
+            keyring.close()
+            return
+
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(keyring)
+                keyring = None
+        if keyring is not None:
+            keyring.close()
+
+    def close(self):
+        "Closes the idle keyrings"
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for keyring in idle:
+            keyring.close()
 
 
 
@@ -138,25 +438,97 @@ class TempSigningKeyring(TempKeyring):
             TempKeyring.__init__(self, *args, **kwargs)
 
         if base_keyring is None:
-            base_keyring = Keyring()
-        # Copy the public parts of the secret keys to the tmpkeyring
-        for fpr, key in base_keyring.get_keys(None,
-                                              secret=True,
-                                              public=False).items():
-            self.import_data (base_keyring.export_data (fpr))
+            # The public parts of the user's secret keys rarely change,
+            # so we copy a prepared keyring file instead of running gpg.
+            # We copy rather than hardlink, so that nothing gpg does
+            # to the signing keyring can ever modify the template.
+            template = get_signing_template()
+            copyfile(template.kr_fname, self.kr_fname)
+        else:
+            self._copy_secret_public_keys(base_keyring)
+
+    def _copy_secret_public_keys(self, base_keyring):
+        "Copies the public parts of the secret keys to the tmpkeyring"
+        keydata = export_secret_public_keys(base_keyring)
+        if keydata:
+            self.import_data(keydata)
+
+
+def export_secret_public_keys(keyring):
+    '''Returns the public parts of all secret keys of the keyring
+
+    All keys are exported with one gpg call.'''
+    fprs = list(keyring.get_keys(None, secret=True, public=False).keys())
+    log.debug('Exporting public parts of secret keys %s', fprs)
+    if not fprs:
+        return None
+    keyring.context.call_command(['export'] + fprs)
+    return keyring.context.stdout
+
+
+_signing_template = None
+_signing_template_lock = threading.Lock()
+
+def _build_signing_template():
+    global _signing_template
+    with keyring_pool.keyring() as keyring:
+        keydata = export_secret_public_keys(keyring) or b''
+    # The keyring may have changed without the secret keys changing,
+    # e.g. when a public key has been imported.  We identify the
+    # template by its contents and keep it if they are the same.
+    if not isinstance(keydata, bytes):
+        keydata = keydata.encode('utf-8')
+    digest = hashlib.sha256(keydata).hexdigest()
+    with _signing_template_lock:
+        if _signing_template is not None and _signing_template[0] == digest:
+            log.debug('Public parts of secret keys have not changed')
+            return _signing_template[1]
+
+    template = TempKeyring()
+    if keydata:
+        template.import_data(keydata)
+    with _signing_template_lock:
+        # The old template is removed once nobody uses it anymore
+        _signing_template = (digest, template)
+    return template
+
+
+def get_signing_template():
+    '''Returns a TempKeyring holding the public parts of the user's
+    secret keys
 
+    It is rebuilt only when the user's keyring changes.
+    Do not modify it.'''
+    return keyring_cache.get(('signing_template',), _build_signing_template)
+
+
+def _close_signing_template():
+    global _signing_template
+    with _signing_template_lock:
+        template, _signing_template = _signing_template, None
+    if template is not None:
+        template[1].close()
+
+
+
+# The pool of scratch keyrings for short-lived operations.
+# We clean up when exiting, because destructors may not be run
+# or run when the modules they need are already gone.
+scratch_pool = ScratchKeyringPool()
+atexit.register(scratch_pool.close)
+atexit.register(_close_signing_template)
 
 
 def openpgpkey_from_data(keydata):
     "Creates an OpenPGP object from given data"
-    keyring = TempKeyring()
-    if not keyring.import_data(keydata):
-        raise ValueError("Could not import %r  -  stdout: %r, stderr: %r",
-                         keydata,
-                         keyring.context.stdout, keyring.context.stderr)
-    # As we have imported only one key, we should also
-    # only have one key at our hands now.
-    keys = keyring.get_keys()
+    with scratch_pool.keyring() as keyring:
+        if not keyring.import_data(keydata):
+            raise ValueError("Could not import %r  -  stdout: %r, stderr: %r",
+                             keydata,
+                             keyring.context.stdout, keyring.context.stderr)
+        # As we have imported only one key, we should also
+        # only have one key at our hands now.
+        keys = keyring.get_keys()
     if len(keys) > 1:
         log.debug('Operation on keydata "%s" failed', keydata)
         raise ValueError("Cannot give the fingerprint for more than "
@@ -180,7 +552,8 @@ def get_public_key_data(fpr, keyring=None):
     In fact, fpr could be anything that gpg happily exports.
     """
     if not keyring:
-        keyring = Keyring()
+        with keyring_pool.keyring() as keyring:
+            return get_public_key_data(fpr, keyring)
     keydata = keyring.export_data(fpr)
     return keydata
 
@@ -192,142 +565,445 @@ def get_public_key_data(fpr, keyring=None):
 #        a key rather than bytes.
 def fingerprint_for_key(keydata):
     '''Returns the OpenPGP Fingerprint for a given key'''
+    try:
+        return openpgp.fingerprint(keydata)
+    except openpgp.PacketError as e:
+        log.info('Cannot determine fingerprint natively, using gpg: %s', e)
     openpgpkey = openpgpkey_from_data(keydata)
     return openpgpkey.fpr
 
 
-def get_usable_keys(keyring=None, *args, **kwargs):
-    '''Uses get_keys on the keyring and filters for
-    non revoked, expired, disabled, or invalid keys'''
-    log.debug('Retrieving keys for %s, %s', args, kwargs)
+def get_usable_keys(keyring=None, pattern=None, secret=False, public=True):
+    '''Lists the keys of the keyring and filters for
+    non revoked, expired, disabled, or invalid keys
+
+    As with monkeysign's get_keys, public selects the public keys
+    and secret the secret keys.  If both are set, the keys found
+    in either listing are returned.
+
+    The keys are returned as a KeyTable rather than a list, so that no
+    objects are created for the keys which are not looked at.  It can
+    be iterated over, indexed, and sliced like the list, but it cannot
+    be modified; use list() for a list of Keys.'''
     if keyring is None:
-        keyring = Keyring()
-    keys_dict = keyring.get_keys(*args, **kwargs)
-    assert keys_dict is not None, keyring.context.stderr
-    def is_usable(key):
-        unusable =    key.invalid or key.disabled \
-                   or key.expired or key.revoked
-        log.debug('Key %s is invalid: %s (i:%s, d:%s, e:%s, r:%s)', key, unusable,
-            key.invalid, key.disabled, key.expired, key.revoked)
-        return not unusable
-    # keys_fpr = keys_dict.items()
-    keys = keys_dict.values()
-    usable_keys = [Key.from_monkeysign(key) for key in keys if is_usable(key)]
+        with keyring_pool.keyring() as keyring:
+            return get_usable_keys(keyring, pattern, secret, public)
+    log.debug('Retrieving keys for %s, secret: %s, public: %s',
+              pattern, secret, public)
+    usable_keys = KeyTable()
+    if public:
+        usable_keys = list_keys(keyring, pattern, secret=False,
+                                predicate=is_usable_record)
+    if secret:
+        secret_keys = list_keys(keyring, pattern, secret=True,
+                                predicate=is_usable_record)
+        if public:
+            usable_keys.update(secret_keys)
+        else:
+            usable_keys = secret_keys
 
     log.debug('Identified usable keys: %s', usable_keys)
     return usable_keys
 
 
 
+class ColonRecord(object):
+    '''A record of GnuPG's --with-colons output
+
+    The line is only split into its fields when a field is accessed,
+    so skipping over records is cheap.  The fields are described in
+    doc/DETAILS of GnuPG.'''
+    __slots__ = ('line', '_fields')
+
+    def __init__(self, line):
+        self.line = line
+        self._fields = None
+
+    @property
+    def type(self):
+        return self.line[:self.line.find(':')]
+
+    @property
+    def fields(self):
+        if self._fields is None:
+            self._fields = self.line.rstrip('\r\n').split(':')
+        return self._fields
+
+    def field(self, index):
+        "Returns the field at index or an empty string if it does not exist"
+        fields = self.fields
+        return fields[index] if index < len(fields) else ''
+
+    validity = property(lambda self: self.field(1))
+    keyid = property(lambda self: self.field(4))
+    created = property(lambda self: self.field(5))
+    expires = property(lambda self: self.field(6))
+    # The user ID for uid and sig records, the fingerprint for fpr records
+    uid = property(lambda self: self.field(9))
+    fingerprint = property(lambda self: self.field(9))
+    sigclass = property(lambda self: self.field(10))
+    capabilities = property(lambda self: self.field(11))
+
+    def __repr__(self):
+        return 'ColonRecord(%r)' % self.line
+
+
+def iter_colon_records(lines, types=None):
+    '''Iterates over the ColonRecords of the given lines
+
+    If types is given, e.g. ('pub', 'fpr'), other records
+    are skipped without being parsed.'''
+    prefixes = tuple(t + ':' for t in types) if types else None
+    for line in lines:
+        if prefixes is None or line.startswith(prefixes):
+            yield ColonRecord(line)
+
+
+def iter_command_lines(keyring, command):
+    '''Runs a gpg command with the options of the keyring and yields
+    the lines of its output as they arrive
+
+    Unlike the Context's call_command, this does not hold the whole
+    output in memory.  If the iteration is stopped early, gpg is killed.'''
+    argv = keyring.context.build_command(command)
+    with open(os.devnull, 'rb') as devnull:
+        # stderr goes to a file, so that gpg cannot block on a full pipe
+        errors = TemporaryFile()
+        proc = subprocess.Popen(argv, stdin=devnull,
+                                stdout=subprocess.PIPE, stderr=errors)
+    try:
+        for line in iter(proc.stdout.readline, b''):
+            if str is not bytes:
+                line = line.decode('utf-8', 'replace')
+            yield line
+    finally:
+        proc.stdout.close()
+        if proc.poll() is None:
+            proc.kill()
+        returncode = proc.wait()
+        if returncode:
+            errors.seek(0)
+            log.debug('%s returned %d: %s', command, returncode, errors.read())
+        errors.close()
+
+
+def is_usable_record(record):
+    '''Returns whether a "pub" ColonRecord is usable
+
+    That is, whether the key is not revoked, expired, disabled,
+    or invalid.'''
+    return (record.validity not in ('i', 'd', 'r', 'e')
+            and 'D' not in record.capabilities)
+
+
+def unescape_colon_field(value):
+    "Decodes the \\xHH escapes gpg uses for user IDs in colon listings"
+    if '\\' not in value:
+        return value
+    raw = value.encode('utf-8') if str is not bytes else value
+    parts = raw.split(b'\\x')
+    result = bytearray(parts[0])
+    for part in parts[1:]:
+        try:
+            result.append(int(part[:2], 16))
+            result += part[2:]
+        except ValueError:
+            result += b'\\x' + part
+    result = bytes(result)
+    return result.decode('utf-8', 'replace') if str is not bytes else result
+
+
+def list_keys(keyring, pattern=None, secret=False, predicate=None):
+    '''Lists the (secret) keys of the keyring as a KeyTable
+
+    If a predicate is given, only keys whose pub or sec
+    ColonRecord satisfy it are included.'''
+    command = ['list-secret-keys' if secret else 'list-keys']
+    if pattern:
+        command.append(pattern)
+    lines = iter_command_lines(keyring, command)
+    records = iter_colon_records(lines, types=('pub', 'sec', 'fpr', 'uid'))
+    return KeyTable.from_records(records, predicate)
+
+
+def get_usable_fingerprints(keyring, fingerprints):
+    '''Returns the set of the given fingerprints with usable public keys
+
+    All fingerprints are looked up with a single list-keys call,
+    rather than one gpg run per fingerprint, and the listing is
+    joined with the given fingerprints in memory.'''
+    fingerprints = list(fingerprints)
+    if not fingerprints:
+        return set()
+
+    # gpg returns non-zero if one of the patterns cannot be found,
+    # but it lists all the others nonetheless.
+    lines = iter_command_lines(keyring, ['list-keys'] + fingerprints)
+    records = iter_colon_records(lines, types=('pub', 'fpr'))
+    return usable_fingerprints_from_records(records, fingerprints)
+
+
+def usable_fingerprints_from_records(records, fingerprints):
+    '''Returns the set of the given fingerprints whose keys are
+    listed as usable in the pub and fpr ColonRecords'''
+    wanted = set(fingerprints)
+    usable = set()
+    pub = None
+    for record in records:
+        if record.type == 'pub':
+            pub = record
+        elif record.type == 'fpr' and pub is not None:
+            # The first fpr record after a pub record belongs to
+            # the primary key, subsequent ones to its subkeys.
+            fpr = record.fingerprint
+            if fpr in wanted and is_usable_record(pub):
+                usable.add(fpr)
+            pub = None
+
+    log.debug('Usable fingerprints: %s', usable)
+    return usable
+
+
 def get_usable_secret_keys(keyring=None, pattern=None):
     '''Returns all secret keys which can be used to sign a key
 
-    Uses get_keys on the keyring and filters for
-    non revoked, expired, disabled, or invalid keys'''
+    Lists the secret keys of the keyring and filters for
+    non revoked, expired, disabled, or invalid keys
+
+    If no keyring is given, the user's keyring is used and the
+    result is cached until the keyring changes.'''
     if keyring is None:
-        keyring = Keyring()
-    secret_keys_dict = keyring.get_keys(pattern=pattern,
-                                        public=False,
-                                        secret=True)
-    secret_key_fprs = secret_keys_dict.keys()
+        def compute():
+            with keyring_pool.keyring() as keyring:
+                return get_usable_secret_keys(keyring, pattern)
+        keys = keyring_cache.get(('usable_secret_keys', pattern), compute)
+        # The caller may modify the list, but not our cached copy
+        return list(keys)
+    secret_keys = list_keys(keyring, pattern, secret=True)
+    secret_key_fprs = secret_keys.fingerprints
     log.debug('Detected secret keys: %s', secret_key_fprs)
-    usable_keys_fprs = filter(lambda fpr: get_usable_keys(keyring, pattern=fpr, public=True), secret_key_fprs)
-    usable_keys = [Key.from_monkeysign(secret_keys_dict[fpr])
-                   for fpr in usable_keys_fprs]
+    usable_keys_fprs = get_usable_fingerprints(keyring, secret_key_fprs)
+    usable_keys = [secret_keys.get(fpr)
+                   for fpr in secret_key_fprs if fpr in usable_keys_fprs]
 
     log.info('Returning usable private keys: %s', usable_keys)
     return usable_keys
 
 
-def sign_keydata_and_encrypt(keydata):
-    "Signs OpenPGP keydata with your regular GnuPG secret keys"
-
-    log = logging.getLogger(__name__ + ':sign_keydata_encrypt')
+def _export_uid_and_encrypt(kr_fname, tdb_fname, fingerprint, uid_str):
+    '''Exports a signed UID off the signing keyring and encrypts it
+
+    A Keyring of our own is set up on the keyring files, so that
+    several UIDs can be processed at the same time.  They only read
+    from the keyring.
+
+    We export and encrypt by fingerprint rather than by UID, because
+    the UID might match another key of the signing keyring.'''
+    keyring = SplitKeyring(kr_fname, tdb_fname)
+    keyring.context.set_option('export-options', 'export-minimal')
+    # See sign_keys for why we need to --always-trust.
+    # We must not have several gpgs update the trustdb concurrently.
+    keyring.context.set_option('always-trust')
+    keyring.context.set_option('no-auto-check-trustdb')
+
+    signed_key = UIDExport(uid_str, keyring.export_data(fingerprint))
+    log.info("Exported %d bytes of signed key", len(signed_key))
+    encrypted_key = keyring.encrypt_data(data=signed_key,
+                                         recipient=fingerprint)
+    return encrypted_key
+
+
+def export_and_encrypt_uids(tmpkeyring, uids, max_workers=4):
+    '''Exports and encrypts each signed UID of a signing keyring
+
+    uids is a sequence of (fingerprint, uid) tuples.
+    Yields (fingerprint, uid, encrypted key) tuples in the order of uids.
+    The UIDs are processed by up to max_workers threads, each of which
+    runs its own gpg processes with a scratch keyring of its own.
+    So the total time is roughly that of the slowest UID rather than
+    the sum of all of them.  With max_workers <= 1 the UIDs are
+    processed one after another.'''
+    uids = list(uids)
+    def process(fpr_uid):
+        fingerprint, uid_str = fpr_uid
+        log.info("Processing uid %s of %s", uid_str, fingerprint)
+        return _export_uid_and_encrypt(tmpkeyring.kr_fname,
+                                       tmpkeyring.tdb_fname,
+                                       fingerprint, uid_str)
+
+    workers = min(max_workers, len(uids))
+    if workers <= 1:
+        pool = None
+        results = (process(fpr_uid) for fpr_uid in uids)
+    else:
+        pool = ThreadPool(workers)
+        # imap hands out the results in order as they become available
+        results = pool.imap(process, uids)
+
+    try:
+        # We do not zip(), because it is not lazy on Python 2
+        for fingerprint, uid_str in uids:
+            yield (fingerprint, uid_str, next(results))
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+
+def sign_keys(tmpkeyring, fingerprints, secret_keys, signers=None):
+    '''Signs all UIDs of the keys with the given fingerprints
+
+    The keys must have been imported into tmpkeyring, which must
+    be able to use the secret keys, i.e. be a TempSigningKeyring.
+    Returns the list of (fingerprint, uid) tuples which have been signed.
+    A key which cannot be found or signed is logged and left out.
+
+    If signers, a dict, is given, the fingerprints of the secret keys
+    which have signed a key are put into it, keyed by the key's
+    fingerprint.'''
+    if signers is None:
+        signers = {}
+    keys = OrderedDict()
+    for fingerprint in fingerprints:
+        found = tmpkeyring.get_keys(fingerprint)
+        log.info("Found keys %s for fp %s", found, fingerprint)
+        if len(found) != 1 or fingerprint not in found:
+            log.error("Expected one key for fp %s, but found %s",
+                      fingerprint, found)
+            continue
+        keys[fingerprint] = found[fingerprint]
+
+    for secret_key in secret_keys:
+        secret_fpr = secret_key.fpr
+        log.info('Setting up to sign with %s', secret_fpr)
+        # We need to --always-trust, because GnuPG would print
+        # warning about the trustdb.  I think this is because
+        # we have a newly signed key whose trust GnuPG wants to
+        # incorporate into the trust decision.
+        tmpkeyring.context.set_option('always-trust')
+        tmpkeyring.context.set_option('local-user', secret_fpr)
+        for fingerprint in keys:
+            # FIXME: For now, we sign all UIDs. This is bad.
+            try:
+                ret = tmpkeyring.sign_key(fingerprint, signall=True)
+            except (GpgProtocolError, GpgRuntimeError) as e:
+                # e.g. gpg does not sign a revoked or expired key
+                log.error("Could not sign key %s with %s: %s",
+                          fingerprint, secret_fpr, e)
+                continue
+            log.info("Result of signing key %s: %s", fingerprint, ret)
+            if ret:
+                signers.setdefault(fingerprint, []).append(secret_fpr)
+            else:
+                log.error("Could not sign key %s with %s: %s", fingerprint,
+                          secret_fpr, tmpkeyring.context.stderr)
+
+    return [(fingerprint, uid.uid)
+            for fingerprint, key in keys.items() if fingerprint in signers
+            for uid in key.uidslist]
+
+
+def sign_keydatas_and_encrypt(keydatas, max_workers=4, signers=None):
+    '''Signs several OpenPGP keys with your regular GnuPG secret keys
+
+    All keys are imported into one signing keyring, so the public parts
+    of the secret keys are copied only once for the whole batch.
+    Keys which cannot be imported are skipped.
+
+    Yields a (fingerprint, uid, encrypted key) tuple for every UID of
+    the keys which has been signed.  max_workers is passed on to
+    export_and_encrypt_uids, signers to sign_keys.'''
+    log = logging.getLogger(__name__ + ':sign_keydatas_encrypt')
 
     tmpkeyring = TempSigningKeyring()
-    tmpkeyring.context.set_option('export-options', 'export-minimal')
-    # Eventually, we want to let the user select their keys to sign with
-    # For now, we just take whatever is there.
-    secret_keys = get_usable_secret_keys(tmpkeyring)
-    log.info('Signing with these keys: %s', secret_keys)
-
-    stripped_key = MinimalExport(keydata)
-    fingerprint = fingerprint_for_key(stripped_key)
+    try:
+        tmpkeyring.context.set_option('export-options', 'export-minimal')
+        # Eventually, we want to let the user select their keys to sign with
+        # For now, we just take whatever is there.
+        secret_keys = get_usable_secret_keys(tmpkeyring)
+        log.info('Signing with these keys: %s', secret_keys)
+
+        fingerprints = []
+        for keydata in keydatas:
+            try:
+                stripped_key = MinimalExport(keydata)
+                fingerprint = fingerprint_for_key(stripped_key)
+            except Exception:
+                log.exception('Could not process a key, skipping it')
+                continue
+
+            log.debug('Trying to import key\n%s', stripped_key)
+            if tmpkeyring.import_data(stripped_key):
+                fingerprints.append(fingerprint)
+            else:
+                log.warning('Could not import key %s: %s',
+                            fingerprint, tmpkeyring.context.stderr)
 
-    log.debug('Trying to import key\n%s', stripped_key)
-    if tmpkeyring.import_data(stripped_key):
         # 3. for every user id (or all, if -a is specified)
         # 3.1. sign the uid, using gpg-agent
-        keys = tmpkeyring.get_keys(fingerprint)
-        log.info("Found keys %s for fp %s", keys, fingerprint)
-        if len(keys) != 1:
-            raise ValueError("We received multiple keys for fp %s: %s"
-                             % (fingerprint, keys))
-        key = keys[fingerprint]
-        uidlist = key.uidslist
-
-        for secret_key in secret_keys:
-            secret_fpr = secret_key.fpr
-            log.info('Setting up to sign with %s', secret_fpr)
-            # We need to --always-trust, because GnuPG would print
-            # warning about the trustdb.  I think this is because
-            # we have a newly signed key whose trust GnuPG wants to
-            # incorporate into the trust decision.
-            tmpkeyring.context.set_option('always-trust')
-            tmpkeyring.context.set_option('local-user', secret_fpr)
-            # FIXME: For now, we sign all UIDs. This is bad.
-            ret = tmpkeyring.sign_key(uidlist[0].uid, signall=True)
-            log.info("Result of signing %s on key %s: %s", uidlist[0].uid, fingerprint, ret)
+        signed_uids = sign_keys(tmpkeyring, fingerprints, secret_keys, signers)
+
+        # 3.2. export and encrypt the signature
+        # 3.3. mail the key to the user
+        for result in export_and_encrypt_uids(tmpkeyring, signed_uids,
+                                              max_workers=max_workers):
+            yield result
+    finally:
+        tmpkeyring.close()
+
+
+def sign_keydata_and_encrypt(keydata, max_workers=4):
+    '''Signs OpenPGP keydata with your regular GnuPG secret keys
 
+    Yields a (uid, encrypted key) tuple for every UID of the key.
+    max_workers is passed on to export_and_encrypt_uids.'''
+    for fingerprint, uid_str, encrypted_key in sign_keydatas_and_encrypt(
+            [keydata], max_workers=max_workers):
+        yield (uid_str, encrypted_key)
 
-        for uid in uidlist:
-            uid_str = uid.uid
-            log.info("Processing uid %s %s", uid, uid_str)
 
-            # 3.2. export and encrypt the signature
-            # 3.3. mail the key to the user
-            signed_key = UIDExport(uid_str, tmpkeyring.export_data(uid_str))
-            log.info("Exported %d bytes of signed key", len(signed_key))
 
-            # self.signui.tmpkeyring.context.set_option('armor')
-            tmpkeyring.context.set_option('always-trust')
-            encrypted_key = tmpkeyring.encrypt_data(data=signed_key, recipient=uid_str)
-            yield (uid.uid, encrypted_key)
+def iter_sigs(lines):
+    '''Iterates over the signatures of a list-sigs colon listing
 
+    Yields (keyid, timestamp, uid) tuples.'''
+    debug = log.isEnabledFor(logging.DEBUG)
+    for record in iter_colon_records(lines, types=('sig',)):
+        if debug:
+            log.debug("sig record %s", record)
+        yield (record.keyid, record.created, record.uid)
 
 
 def parse_sig_list(text):
     '''Parses GnuPG's signature list (i.e. list-sigs)
 
     The format is described in the GnuPG man page'''
-    sigslist = []
-    for block in text.split("\n"):
-        if block.startswith("sig"):
-            record = block.split(":")
-            log.debug("sig record (%d) %s", len(record), record)
-            keyid, timestamp, uid = record[4], record[5], record[9]
-            sigslist.append((keyid, timestamp, uid))
+    return list(iter_sigs(text.split("\n")))
 
-    return sigslist
+
+def iter_signatures_for_keyid(keyid, keyring):
+    '''Iterates over the signatures for a given key id
+
+    The output of gpg is parsed while it is being read, so even
+    keys with many thousand signatures take constant memory.'''
+    return iter_sigs(iter_command_lines(keyring, ['list-sigs', keyid]))
 
 
 def signatures_for_keyid(keyid, keyring=None):
     '''Returns the list of signatures for a given key id
 
-    This will call out to GnuPG list-sigs, using Monkeysign,
-    and parse the resulting string into a list of signatures.
+    This will call out to GnuPG list-sigs and parse
+    the resulting lines into a list of signatures.
 
     A default Keyring will be used unless you pass an instance
     as keyring argument.
     '''
     if keyring is None:
-        kr = Keyring()
+        with keyring_pool.keyring() as kr:
+            return signatures_for_keyid(keyid, kr)
     else:
         kr = keyring
 
-    # FIXME: this would be better if it was done in monkeysign
-    kr.context.call_command(['list-sigs', keyid])
-    siglist = parse_sig_list(kr.context.stdout)
+    siglist = list(iter_signatures_for_keyid(keyid, kr))
 
     return siglist
 
@@ -353,16 +1029,67 @@ def parse_uid(uid):
     return (name, comment, email)
 
 
-class UID(namedtuple("UID", "expiry name comment email")):
-    "Represents an OpenPGP UID - at least to the extent we care about it"
+class UID(object):
+    """Represents an OpenPGP UID - at least to the extent we care about it
+
+    A UID may be created from the raw UID string with from_uid_string,
+    in which case it is only parsed into its name, comment, and email
+    when one of them is accessed."""
+    __slots__ = ('expiry', '_uidstr', '_parsed')
+    _fields = ('expiry', 'name', 'comment', 'email')
+
+    def __init__(self, expiry, name, comment, email):
+        self.expiry = expiry
+        self._uidstr = None
+        self._parsed = (name, comment, email)
+
+    @classmethod
+    def from_uid_string(cls, uidstr, expiry=None):
+        "Creates a new UID which parses uidstr when needed"
+        uid = cls.__new__(cls)
+        uid.expiry = expiry
+        uid._uidstr = uidstr
+        uid._parsed = None
+        return uid
 
     @classmethod
     def from_monkeysign(cls, uid):
         "Creates a new UID from a monkeysign key"
-        uidstr = uid.uid
-        name, comment, email = parse_uid(uidstr)
-        expiry = uid.expire
-        return cls(expiry, name, comment, email)
+        return cls.from_uid_string(uid.uid, uid.expire)
+
+    def _parse(self):
+        if self._parsed is None:
+            self._parsed = parse_uid(self._uidstr)
+        return self._parsed
+
+    name = property(lambda self: self._parse()[0])
+    comment = property(lambda self: self._parse()[1])
+    email = property(lambda self: self._parse()[2])
+
+    def _astuple(self):
+        return (self.expiry,) + self._parse()
+
+    def _asdict(self):
+        return OrderedDict(zip(self._fields, self._astuple()))
+
+    def __iter__(self):
+        return iter(self._astuple())
+
+    def __eq__(self, other):
+        if not isinstance(other, UID):
+            return NotImplemented
+        return self._astuple() == other._astuple()
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __hash__(self):
+        return hash(self._astuple())
+
+    def __repr__(self):
+        return 'UID(%s)' % ', '.join('%s=%r' % item
+                                     for item in self._asdict().items())
 
     def __format__(self, arg):
         if self.comment:
@@ -382,21 +1109,61 @@ class UID(namedtuple("UID", "expiry name comment email")):
         return str(self)
 
 
-class Key(namedtuple("Key", "expiry fingerprint uidslist")):
-    "Represents an OpenPGP Key to extent we care about"
+_NOT_CONVERTED = object()
 
-    def __init__(self, expiry, fingerprint, uidslist,
-                       *args, **kwargs):
-        try:
-            exp_date = datetime.fromtimestamp(float(expiry))
-        except TypeError as e:
-            # This might be the case when the key.expiry is already a timedate
-            exp_date = expiry
-        except ValueError as e:
-            # This happens when converting an empty string to a datetime.
-            exp_date = None
+class Key(object):
+    """Represents an OpenPGP Key to extent we care about
 
-        super(Key, self).__init__(exp_date, fingerprint, uidslist)
+    The expiry is given as it comes from gpg, i.e. as a timestamp
+    string, and only converted into a datetime when accessed."""
+    __slots__ = ('_raw_expiry', '_expiry', 'fingerprint', 'uidslist')
+    _fields = ('expiry', 'fingerprint', 'uidslist')
+    # The uidslist is a list
+    __hash__ = None
+
+    def __init__(self, expiry, fingerprint, uidslist):
+        self._raw_expiry = expiry
+        self._expiry = _NOT_CONVERTED
+        self.fingerprint = fingerprint
+        self.uidslist = uidslist
+
+    @property
+    def expiry(self):
+        "The expiry as datetime or None if the key does not expire"
+        if self._expiry is _NOT_CONVERTED:
+            expiry = self._raw_expiry
+            try:
+                exp_date = datetime.fromtimestamp(float(expiry))
+            except TypeError as e:
+                # This might be the case when the key.expiry is already a timedate
+                exp_date = expiry
+            except ValueError as e:
+                # This happens when converting an empty string to a datetime.
+                exp_date = None
+            self._expiry = exp_date
+        return self._expiry
+
+    def _astuple(self):
+        return (self.expiry, self.fingerprint, self.uidslist)
+
+    def _asdict(self):
+        return OrderedDict(zip(self._fields, self._astuple()))
+
+    def __iter__(self):
+        return iter(self._astuple())
+
+    def __eq__(self, other):
+        if not isinstance(other, Key):
+            return NotImplemented
+        return self._astuple() == other._astuple()
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __repr__(self):
+        return 'Key(%s)' % ', '.join('%s=%r' % item
+                                     for item in self._asdict().items())
 
     def __format__(self, arg):
         s  = "{fingerprint}\r\n"
@@ -425,6 +1192,110 @@ class Key(namedtuple("Key", "expiry fingerprint uidslist")):
         return cls(expiry, fingerprint, uids)
 
 
+class KeyTable(object):
+    """A compact, read-only sequence of many Keys
+
+    Rather than a Key and UID objects per key, it keeps the raw
+    fingerprints, expiries, and UID strings in flat lists.
+    The Keys are created only when they are accessed, so listing a
+    keyring with thousands of keys does not create thousands of objects.
+    """
+    def __init__(self):
+        self.fingerprints = []
+        self.expiries = []
+        # The UIDs of the i-th key are uids[uid_offsets[i]:uid_offsets[i+1]]
+        self.uid_offsets = [0]
+        self.uids = []
+        self.uid_expiries = []
+        self._index = {}
+
+    def append(self, fingerprint, expiry, uids):
+        "Adds a key with uids being a sequence of (uid, expiry) tuples"
+        self._index[fingerprint] = len(self.fingerprints)
+        self.fingerprints.append(fingerprint)
+        self.expiries.append(expiry)
+        for uid, uid_expiry in uids:
+            self.uids.append(uid)
+            self.uid_expiries.append(uid_expiry)
+        self.uid_offsets.append(len(self.uids))
+
+    def update(self, other):
+        "Adds the keys of another KeyTable which are not in this one"
+        for i, fingerprint in enumerate(other.fingerprints):
+            if fingerprint in self._index:
+                continue
+            start, end = other.uid_offsets[i], other.uid_offsets[i+1]
+            self.append(fingerprint, other.expiries[i],
+                        zip(other.uids[start:end],
+                            other.uid_expiries[start:end]))
+
+    @classmethod
+    def from_records(cls, records, predicate=None):
+        '''Creates a table from a colon listing
+
+        Keys whose pub (or sec) ColonRecord does not satisfy
+        the predicate are left out.'''
+        table = cls()
+        key = None
+        uids = []
+        def flush():
+            if key is not None and key[1] is not None:
+                table.append(key[1], key[0].expires, uids)
+
+        for record in records:
+            rtype = record.type
+            if rtype in ('pub', 'sec'):
+                flush()
+                uids = []
+                if predicate is None or predicate(record):
+                    # The record and, later, its fingerprint
+                    key = [record, None]
+                else:
+                    key = None
+            elif key is None:
+                continue
+            elif rtype == 'fpr':
+                # Only the first fpr after a pub belongs to the primary key
+                if key[1] is None:
+                    key[1] = record.fingerprint
+            elif rtype == 'uid':
+                uids.append((unescape_colon_field(record.uid),
+                             record.expires))
+        flush()
+        return table
+
+    def __len__(self):
+        return len(self.fingerprints)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        start, end = self.uid_offsets[index], self.uid_offsets[index+1]
+        uids = [UID.from_uid_string(uid, expiry)
+                for uid, expiry in zip(self.uids[start:end],
+                                       self.uid_expiries[start:end])]
+        return Key(self.expiries[index], self.fingerprints[index], uids)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __contains__(self, fingerprint):
+        return fingerprint in self._index
+
+    def get(self, fingerprint, default=None):
+        "Returns the Key for the fingerprint"
+        index = self._index.get(fingerprint)
+        if index is None:
+            return default
+        return self[index]
+
+    def __repr__(self):
+        return 'KeyTable(%r)' % self.fingerprints
+
+
 ## Monkeypatching to get more debug output
 import monkeysign.gpg
 bc = monkeysign.gpg.Context.build_command
@@ -24,43 +24,65 @@ from dbus.mainloop.glib import DBusGMainLoop
 from gi.repository import Gio
 from gi.repository import GObject
 
+from collections import deque
 import logging
+import time
+
+from .AvahiSession import AvahiSession, avahi_session
 
 __all__ = ["AvahiBrowser"]
 
 
-# This should probably be upstreamed.
-# Unfortunately, upstream seems rather inactive.
-if getattr(avahi, 'txt_array_to_dict', None) is None:
-    # This has been taken from Gajim
-    # http://hg.gajim.org/gajim/file/4a3f896130ad/src/common/zeroconf/zeroconf_avahi.py
-    # it is licensed under the GPLv3.
-    def txt_array_to_dict(txt_array):
-        txt_dict = {}
-        for els in txt_array:
-            key, val = '', None
-            for c in els:
-                    #FIXME: remove when outdated, this is for avahi < 0.6.14
-                    if c < 0 or c > 255:
-                        c = '.'
-                    else:
-                        c = chr(c)
-                    if val is None:
-                        if c == '=':
-                            val = ''
-                        else:
-                            key += c
-                    else:
-                        val += c
-            if val is None: # missing '='
-                val = ''
-            txt_dict[key] = val.decode('utf-8')
-        return txt_dict
-
-    setattr(avahi, 'txt_array_to_dict', txt_array_to_dict)
+class TxtRecord(dict):
+    '''The TXT record of a service, mapping its keys to their values
+
+    The fingerprint the service advertises, if any, is available as
+    the fingerprint attribute, without spaces and in upper case.
+    '''
+    def __init__(self, *args, **kwargs):
+        super(TxtRecord, self).__init__(*args, **kwargs)
+        fpr = self.get('fingerprint')
+        self.fingerprint = ''.join(fpr.split()).upper() if fpr else None
+
+
+def txt_entry_text(entry):
+    '''Returns an entry of a TXT array, i.e. an array of bytes,
+    decoded as UTF-8, with invalid sequences replaced'''
+    try:
+        data = bytearray(entry)
+    except ValueError:
+        #FIXME: remove when outdated, this is for avahi < 0.6.14
+        data = bytearray(c if 0 <= c <= 255 else ord('.') for c in entry)
+    return data.decode('utf-8', 'replace')
+
+
+def txt_array_to_record(txt_array):
+    '''Decodes the TXT array of a resolved service into a TxtRecord
+
+    Each entry is converted and decoded in one go rather than byte
+    by byte.  An entry without '=' has an empty value and, as in
+    RFC 6763, only the first of several entries with a key counts.'''
+    record = {}
+    for entry in txt_array:
+        key, _, value = txt_entry_text(entry).partition(u'=')
+        if key not in record:
+            record[key] = value
+    return TxtRecord(record)
 
 
 class AvahiBrowser(GObject.GObject):
+    '''Emits the _keysign._tcp services found on the network
+
+    Avahi reports a service once per interface and protocol it is seen
+    on.  It is resolved once per protocol, to an address of that
+    protocol, however many interfaces it is seen on.  The result is
+    cached for resolve_ttl seconds, so that the services reported again
+    after avahi-daemon has restarted are not resolved again.  The cache
+    is dropped when a service goes away, as it may come back on another
+    port.  At most max_resolves services are resolved at a time, the
+    others wait in a queue.
+    Services of our own host are skipped, unless skip_local is False.
+    '''
     __gsignals__ = {
         'new_service': (GObject.SIGNAL_RUN_LAST, None,
             # name, address (could be an int too (for IPv4)), port, txt_dict
@@ -71,51 +93,190 @@ class AvahiBrowser(GObject.GObject):
     }
 
 
-    def __init__(self, loop=None, service='_keysign._tcp'):
+    def __init__(self, loop=None, service='_keysign._tcp', session=None,
+                 skip_local=True, resolve_ttl=30, max_resolves=8):
         GObject.GObject.__init__(self)
 
         self.log = logging.getLogger()
         self.service = service
+        self.skip_local = skip_local
+        self.resolve_ttl = resolve_ttl
+        self.max_resolves = max_resolves
+
+        # Maps (name, type, domain) to the set of (interface, protocol)
+        # tuples the service has been reported on
+        self._items = {}
+        # Maps (name, type, domain, protocol) to
+        # (time, address, port, txt_dict)
+        self._resolved = {}
+        # The (name, type, domain, protocol) being resolved and those
+        # waiting, with the interface they are resolved on
+        self._resolving = set()
+        self._queue = deque()
+        # Replies for an earlier browser are ignored
+        self._generation = 0
+        # The bus and the Avahi server are shared with the publishers,
+        # unless we are given a loop of our own.
         # It seems that these are different loops..?!
-        self.loop = loop or DBusGMainLoop()
-        self.bus = dbus.SystemBus(mainloop=self.loop)
+        if session is None:
+            session = AvahiSession(loop) if loop else avahi_session
+        self.session = session
+        self.loop = session.loop
+        self.bus = session.bus
 
-        self.server = dbus.Interface( self.bus.get_object(avahi.DBUS_NAME, '/'),
-                'org.freedesktop.Avahi.Server')
+        self.server = None
+        self.sbrowser = None
+        self.browse()
+        self.session.connect('reconnected', self.on_avahi_reconnected)
 
-        self.sbrowser = dbus.Interface(self.bus.get_object(avahi.DBUS_NAME,
-            self.server.ServiceBrowserNew(avahi.IF_UNSPEC,
-                avahi.PROTO_UNSPEC, self.service, 'local', dbus.UInt32(0))),
-            avahi.DBUS_INTERFACE_SERVICE_BROWSER)
+
+    def browse(self):
+        '''Creates the service browser'''
+        # Avahi is going to report all the services again
+        self._generation += 1
+        self._items.clear()
+        self._resolving.clear()
+        self._queue.clear()
+        self.server = self.session.server
+        self.sbrowser = self.session.service_browser(self.service)
 
         self.sbrowser.connect_to_signal("ItemNew", self.on_new_item)
         self.sbrowser.connect_to_signal("ItemRemove", self.on_service_removed)
 
 
+    def on_avahi_reconnected(self, session):
+        '''avahi-daemon has restarted and our browser is gone'''
+        self.log.info("Avahi restarted, browsing for '%s' again", self.service)
+        self.browse()
+
+
     def on_new_item(self, interface, protocol, name, stype, domain, flags):
         self.log.info("Found service '%s' type '%s' domain '%s' ", name, stype, domain)
 
-        if flags & avahi.LOOKUP_RESULT_LOCAL:
-            # FIXME skip local services
-            pass
+        if flags & avahi.LOOKUP_RESULT_LOCAL and self.skip_local:
+            self.log.debug("Skipping local service '%s'", name)
+            return
+
+        key = (name, stype, domain)
+        instances = self._items.setdefault(key, set())
+        known = bool(self.interfaces(key + (protocol,)))
+        instances.add((interface, protocol))
+        if known:
+            # Seen on another interface, which does not
+            # need to be resolved again
+            return
+
+        rkey = key + (protocol,)
+        cached = self._resolved.get(rkey)
+        if cached is not None and cached[0] > time.time() - self.resolve_ttl:
+            self.log.debug("Using the cached resolution of '%s'", name)
+            self.emit_service(name, *cached[1:])
+            return
+
+        self._queue.append((rkey, interface))
+        self.resolve_next()
+
+
+    def interfaces(self, rkey):
+        '''Returns the interfaces a service is reported on with a protocol'''
+        name, stype, domain, protocol = rkey
+        return [i for i, p in self._items.get((name, stype, domain), ())
+                if p == protocol]
+
+
+    def resolve_next(self):
+        '''Resolves the queued services, as far as max_resolves allows'''
+        while self._queue and len(self._resolving) < self.max_resolves:
+            rkey, interface = self._queue.popleft()
+            if rkey in self._resolving or not self.interfaces(rkey):
+                # Being resolved already or gone in the meantime
+                continue
+            self.resolve(rkey, interface)
+
+
+    def resolve(self, rkey, interface):
+        '''Resolves a service to an address of the protocol it was found on
+
+        An IPv6 report resolved to "any" protocol may well give a
+        link-local address, which is useless without its scope,
+        while the IPv4 address of the same service is not asked for.'''
+        self._resolving.add(rkey)
+        name, stype, domain, protocol = rkey
+        generation = self._generation
+        def on_resolved(*args, **kwargs):
+            if generation != self._generation:
+                # The service has been reported again since and, if it
+                # still is there, resolved again, maybe to another port
+                return
+            self.on_resolve_done(generation, rkey)
+            if self.interfaces(rkey):
+                self.on_service_resolved(*args, **kwargs)
+        def on_error(error):
+            self.on_error(error)
+            if (generation == self._generation
+                    and interface != avahi.IF_UNSPEC
+                    and len(self.interfaces(rkey)) > 1):
+                # It may still resolve on one of the others
+                self._queue.append((rkey, avahi.IF_UNSPEC))
+            self.on_resolve_done(generation, rkey)
         self.server.ResolveService(interface, protocol, name, stype,
-            domain, avahi.PROTO_UNSPEC, dbus.UInt32(0),
-            reply_handler=self.on_service_resolved,
-            error_handler=self.on_error)
+            domain, protocol, dbus.UInt32(0),
+            reply_handler=on_resolved,
+            error_handler=on_error)
+
+
+    def on_resolve_done(self, generation, rkey):
+        if generation == self._generation:
+            self._resolving.discard(rkey)
+            self.resolve_next()
 
 
     def on_service_resolved(self, interface, protocol, name, stype, domain,
                                   host, aprotocol, address, port, txt, flags):
         '''called when the browser successfully found a service'''
-        txt = avahi.txt_array_to_dict(txt)
+        txt = txt_array_to_record(txt)
+        now = time.time()
+        self._resolved[(name, stype, domain, protocol)] = (
+            now, address, port, txt)
+        self.expire_resolved(now)
+        self.emit_service(name, address, port, txt)
+
+
+    def service_names(self):
+        '''Returns the names of the services Avahi currently reports'''
+        return set(name for name, stype, domain in self._items)
+
+
+    def emit_service(self, name, address, port, txt):
         self.log.info("Service resolved; name: '%s', address: '%s',"
                 "port: '%s', and txt: '%s'", name, address, port, txt)
         retval = self.emit('new_service', name, address, port, txt)
         self.log.info("emitted '%s'", retval)
 
 
+    def expire_resolved(self, now):
+        '''Forgets the resolutions older than resolve_ttl'''
+        deadline = now - self.resolve_ttl
+        for key, cached in list(self._resolved.items()):
+            if cached[0] <= deadline:
+                del self._resolved[key]
+
+
     def on_service_removed(self, interface, protocol, name, stype, domain, flags):
         '''Emits items to be removed from list of discovered services.'''
+        key = (name, stype, domain)
+        instances = self._items.get(key)
+        if instances is None:
+            # A service we have skipped
+            return
+        instances.discard((interface, protocol))
+        if not self.interfaces(key + (protocol,)):
+            # It may come back with another address or port
+            self._resolved.pop(key + (protocol,), None)
+        if instances:
+            # Still there on another interface or protocol
+            return
+        del self._items[key]
         self.log.info("Service removed; name: '%s'", name)
         retval = self.emit('remove_service', 'remove', name)
         self.log.info("emitted '%s'", retval)
@@ -126,6 +287,28 @@ class AvahiBrowser(GObject.GObject):
         print args[0]
 
 
+def benchmark(services=500, entries=8, size=64, number=10):
+    '''Prints how long decoding the TXT arrays of many services takes'''
+    import timeit
+    arrays = []
+    for i in range(services):
+        txt = {'fingerprint': '%040X' % i, 'version': '0.1'}
+        for j in range(entries - len(txt)):
+            txt['key%d' % j] = ('%d' % j) * size
+        arrays.append(dbus.Array(
+            [dbus.Array([dbus.Byte(ord(c)) for c in '%s=%s' % item],
+                        signature='y')
+             for item in txt.items()],
+            signature='ay'))
+
+    def decode_all():
+        for txt_array in arrays:
+            txt_array_to_record(txt_array)
+    seconds = min(timeit.repeat(decode_all, number=number, repeat=3)) / number
+    print "Decoded %d TXT arrays of %d entries in %.2f ms (%.1f us each)" % (
+        services, entries, seconds * 1000, seconds * 1e6 / services)
+
+
 def main():
     loop = GObject.MainLoop()
     # We're not passing the loop to DBus, because... well, it
@@ -142,4 +325,8 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    import sys
+    if '--benchmark' in sys.argv[1:]:
+        benchmark()
+    else:
+        main()
@@ -17,6 +17,7 @@
 #
 #    You should have received a copy of the GNU General Public License
 #    along with GNOME Keysign.  If not, see <http://www.gnu.org/licenses/>.
+from collections import OrderedDict
 import logging
 
 import avahi
@@ -24,7 +25,16 @@ import dbus
 from dbus.mainloop.glib import DBusGMainLoop
 from gi.repository import GObject
 
+from .AvahiSession import avahi_session
+
 class AvahiPublisher:
+    '''Publishes services of one type and port in one entry group
+
+    The service given to the constructor is published with
+    add_service.  More services can be published alongside with
+    set_service, e.g. one per key a keyserver serves.
+    Call close when done, so that the shared session lets go of us.
+    '''
 
     def __init__(self,
             service_name='Demo Service',
@@ -32,13 +42,17 @@ class AvahiPublisher:
             service_port=8899,
             service_txt={},
             domain='',
-            host=''):
+            host='',
+            session=None):
         self.log = logging.getLogger()
         #self.loop = loop or DBusGMainLoop()
-        self.bus = dbus.SystemBus()
-        self.server = dbus.Interface(
-            self.bus.get_object( avahi.DBUS_NAME, avahi.DBUS_PATH_SERVER ),
-            avahi.DBUS_INTERFACE_SERVER )
+        # The bus and the Avahi server are shared with the other
+        # publishers and the browser
+        self.session = session or avahi_session
+        self.bus = self.session.bus
+        self.server = self.session.server
+        self._reconnected_handler = self.session.connect(
+            'reconnected', self.on_avahi_reconnected)
 
         self.service_name = service_name
         #See http://www.dns-sd.org/ServiceTypes.html
@@ -48,42 +62,80 @@ class AvahiPublisher:
         self.domain = domain # Domain to publish on, default to .local
         self.host = host # Host to publish records for, default to localhost
 
+        # Maps the names of the services to publish to the names they
+        # are published with, which differ after collisions, and
+        # their TXT arrays
+        self.services = OrderedDict()
+        if service_name:
+            self.services[service_name] = (service_name, self.service_txt)
+
         self.group = None
         # Counter so we only rename after collisions a sensible number of times
         self.rename_count = 12
 
 
     def add_service(self):
+        '''Publishes all services in the entry group'''
         if self.group is None:
-            group = dbus.Interface(
-                    self.bus.get_object(
-                        avahi.DBUS_NAME, self.server.EntryGroupNew()),
-                    avahi.DBUS_INTERFACE_ENTRY_GROUP)
+            group = self.session.entry_group()
             group.connect_to_signal('StateChanged',
                 self.entry_group_state_changed)
 
             self.group = group
 
-        self.log.info("Adding service '%s' of type '%s' with fpr '%s'",
-            self.service_name, self.service_type, self.service_txt)
-
         group = self.group
-        group.AddService(
-                avahi.IF_UNSPEC,    #interface
-                avahi.PROTO_UNSPEC, #protocol
-                dbus.UInt32 (0),    #flags
-                self.service_name, self.service_type,
-                self.domain, self.host,
-                dbus.UInt16 (self.service_port),
-                self.service_txt)
-        group.Commit()
+        for name, txt in self.services.values():
+            self.log.info("Adding service '%s' of type '%s' with fpr '%s'",
+                name, self.service_type, txt)
+            group.AddService(
+                    avahi.IF_UNSPEC,    #interface
+                    avahi.PROTO_UNSPEC, #protocol
+                    dbus.UInt32 (0),    #flags
+                    name, self.service_type,
+                    self.domain, self.host,
+                    dbus.UInt16 (self.service_port),
+                    txt)
+        if self.services:
+            group.Commit()
 
     def remove_service(self):
         '''Publishes services to be removed with name, stype, and domain.'''
-        self.log.info("Removing with fpr '%s'", self.service_txt)
+        self.log.info("Removing with fpr '%s'",
+            [txt for name, txt in self.services.values()])
         if not self.group is None:
             self.group.Reset()
 
+    def set_service(self, name, txt):
+        '''Publishes (or updates) another service on our port
+
+        An entry group cannot be changed once committed, so
+        the group is reset and all services are published again.'''
+        published_name = self.services.get(name, (name, None))[0]
+        self.services[name] = (published_name, avahi.dict_to_txt_array(txt))
+        self.remove_service()
+        self.add_service()
+
+    def unset_service(self, name):
+        '''Stops publishing the service with the name'''
+        if self.services.pop(name, None) is not None:
+            self.remove_service()
+            self.add_service()
+
+    def close(self):
+        '''Removes the services and stops publishing them again
+        when avahi-daemon restarts'''
+        self.remove_service()
+        if self._reconnected_handler is not None:
+            self.session.disconnect(self._reconnected_handler)
+            self._reconnected_handler = None
+
+    def on_avahi_reconnected(self, session):
+        '''avahi-daemon has restarted and our entry group is gone'''
+        self.log.info("Avahi restarted, publishing again")
+        self.server = session.server
+        self.group = None
+        self.add_service()
+
     def server_state_changed(self, state):
         if state == avahi.SERVER_COLLISION:
             self.log.warn("Server name collision (%s)", self.service_name)
@@ -100,9 +152,13 @@ class AvahiPublisher:
         elif state == avahi.ENTRY_GROUP_COLLISION:
             self.rename_count -= 1
             if self.rename_count > 0:
-                name = self.server.GetAlternativeServiceName(self.service_name)
-                self.log.warn("Service name collision, changing name to '%s'",
-                    name)
+                # We do not know which of our services collided,
+                # so they all get new names.
+                for key, (old_name, txt) in list(self.services.items()):
+                    name = self.server.GetAlternativeServiceName(old_name)
+                    self.log.warn("Service name collision, changing name to '%s'",
+                        name)
+                    self.services[key] = (name, txt)
                 self.remove_service()
                 self.add_service()
 
@@ -127,11 +183,7 @@ if __name__ == '__main__':
     ap.add_service()
 
     main_loop = GObject.MainLoop()
-    bus = dbus.SystemBus()
-
-    server = dbus.Interface(
-            bus.get_object( avahi.DBUS_NAME, avahi.DBUS_PATH_SERVER ),
-            avahi.DBUS_INTERFACE_SERVER )
+    server = ap.server
 
     server.connect_to_signal( "StateChanged", ap.server_state_changed )
     ap.server_state_changed( server.GetState() )
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+#    Copyright 2016 Andrei Macavei <andrei.macavei89@gmail.com>
+#
+#    This file is part of GNOME Keysign.
+#
+#    GNOME Keysign is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    GNOME Keysign is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with GNOME Keysign.  If not, see <http://www.gnu.org/licenses/>.
+"""The connection to avahi-daemon shared by browsers and publishers
+
+Connecting to the system bus and looking up the Avahi server takes
+a few round trips.  The AvahiBrowser and the AvahiPublishers use
+the avahi_session, so that this happens once per process rather
+than once per browser or per key being presented.
+"""
+import logging
+
+import avahi
+import dbus
+from dbus.mainloop.glib import DBusGMainLoop
+from gi.repository import GObject
+
+log = logging.getLogger(__name__)
+
+__all__ = ["AvahiSession", "avahi_session"]
+
+
+class AvahiSession(GObject.GObject):
+    '''One system bus connection and one proxy of the Avahi server
+
+    Both are made when first needed.  Service browsers and entry
+    groups are created through the session.  They live in
+    avahi-daemon, so they are gone when it restarts.  The session
+    then drops the server proxy, which is made again when it is
+    next used, and emits 'reconnected', so that the browsers and
+    publishers can create theirs again.
+    '''
+    __gsignals__ = {
+        'disconnected': (GObject.SIGNAL_RUN_LAST, None, ()),
+        'reconnected': (GObject.SIGNAL_RUN_LAST, None, ()),
+    }
+
+    def __init__(self, loop=None):
+        GObject.GObject.__init__(self)
+        self.loop = loop
+        self._bus = None
+        self._server = None
+        self._owner_watch = None
+        # The unique bus name of avahi-daemon, '' while it is not running,
+        # and None before we know
+        self._owner = None
+
+    @property
+    def bus(self):
+        if self._bus is None:
+            self._bus = dbus.SystemBus(mainloop=self.loop or DBusGMainLoop())
+            self._owner_watch = self._bus.watch_name_owner(
+                avahi.DBUS_NAME, self._on_owner_changed)
+        return self._bus
+
+    @property
+    def server(self):
+        "The org.freedesktop.Avahi.Server interface"
+        if self._server is None:
+            self._server = self.interface(avahi.DBUS_PATH_SERVER,
+                                          avahi.DBUS_INTERFACE_SERVER)
+        return self._server
+
+    def interface(self, path, interface):
+        "Returns the interface of an object of avahi-daemon"
+        return dbus.Interface(self.bus.get_object(avahi.DBUS_NAME, path),
+                              interface)
+
+    def service_browser(self, service_type, domain='local',
+                        interface=avahi.IF_UNSPEC, protocol=avahi.PROTO_UNSPEC):
+        "Returns a new ServiceBrowser for the service type"
+        path = self.server.ServiceBrowserNew(interface, protocol, service_type,
+                                             domain, dbus.UInt32(0))
+        return self.interface(path, avahi.DBUS_INTERFACE_SERVICE_BROWSER)
+
+    def entry_group(self):
+        "Returns a new, empty EntryGroup"
+        return self.interface(self.server.EntryGroupNew(),
+                              avahi.DBUS_INTERFACE_ENTRY_GROUP)
+
+    def _on_owner_changed(self, owner):
+        previous, self._owner = self._owner, owner
+        if previous is None or owner == previous:
+            # This is the initial call with the current owner
+            return
+        # The objects of the old daemon are gone, and so is our proxy
+        self._server = None
+        if not owner:
+            log.info('avahi-daemon has gone away')
+            self.emit('disconnected')
+        else:
+            log.info('avahi-daemon is back as %s', owner)
+            self.emit('reconnected')
+
+    def close(self):
+        if self._owner_watch is not None:
+            self._owner_watch.cancel()
+            self._owner_watch = None
+        self._server = None
+        self._bus = None
+
+
+# The session of the application
+avahi_session = AvahiSession()
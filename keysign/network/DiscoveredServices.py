@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+#    Copyright 2016 Andrei Macavei <andrei.macavei89@gmail.com>
+#
+#    This file is part of GNOME Keysign.
+#
+#    GNOME Keysign is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    GNOME Keysign is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with GNOME Keysign.  If not, see <http://www.gnu.org/licenses/>.
+"""Keeps track of the keyservers the AvahiBrowser has found
+
+Services come and go all the time when many people are around,
+so services can be added, removed, and looked up by name or by
+the fingerprint they advertise without going through all of them.
+"""
+from collections import OrderedDict
+import logging
+import time
+
+from gi.repository import GObject
+
+log = logging.getLogger(__name__)
+
+__all__ = ["DiscoveredService", "DiscoveredServices"]
+
+
+class DiscoveredService(object):
+    '''A resolved _keysign._tcp service
+
+    The fingerprint is what the service advertises in its TXT
+    record, which is not necessarily the key it serves.
+    '''
+    __slots__ = ('name', 'address', 'port', 'fingerprint',
+                 'first_seen', 'last_seen')
+
+    def __init__(self, name, address, port, fingerprint, seen=None):
+        self.name = name
+        self.address = address
+        self.port = port
+        self.fingerprint = fingerprint
+        self.first_seen = self.last_seen = seen or time.time()
+
+    @property
+    def id(self):
+        "Identifies the service, which may be resolved on several addresses"
+        return (self.name, self.address, self.port)
+
+    def __repr__(self):
+        return 'DiscoveredService(%r, %r, %r, %r)' % (
+            self.name, self.address, self.port, self.fingerprint)
+
+
+class DiscoveredServices(GObject.GObject):
+    '''The services found on the network, indexed by name and fingerprint
+
+    A service with the same name, address, and port as a known one
+    replaces it, updating its fingerprint and last_seen.  The same
+    name may be resolved on several addresses, e.g. IPv4 and IPv6.
+    This is not thread-safe and meant to be used from the main loop.
+    '''
+    __gsignals__ = {
+        'service-added': (GObject.SIGNAL_RUN_LAST, None,
+            # the DiscoveredService
+            (GObject.TYPE_PYOBJECT,)),
+        'service-updated': (GObject.SIGNAL_RUN_LAST, None,
+            # the DiscoveredService, which has been seen again
+            (GObject.TYPE_PYOBJECT,)),
+        'service-removed': (GObject.SIGNAL_RUN_LAST, None,
+            # the DiscoveredService
+            (GObject.TYPE_PYOBJECT,)),
+    }
+
+    def __init__(self):
+        GObject.GObject.__init__(self)
+        # Maps the id to the DiscoveredService, in the order of discovery
+        self._services = OrderedDict()
+        # Map the name and fingerprint to OrderedDicts of ids,
+        # which we use as ordered sets.
+        self._by_name = {}
+        self._by_fingerprint = {}
+
+    def __len__(self):
+        return len(self._services)
+
+    def __iter__(self):
+        return iter(list(self._services.values()))
+
+    def __contains__(self, name):
+        return name in self._by_name
+
+    @staticmethod
+    def _index_add(index, key, service_id):
+        index.setdefault(key, OrderedDict())[service_id] = None
+
+    @staticmethod
+    def _index_remove(index, key, service_id):
+        ids = index.get(key)
+        if ids is not None:
+            ids.pop(service_id, None)
+            if not ids:
+                del index[key]
+
+    def add(self, name, address, port, fingerprint, seen=None):
+        "Adds or refreshes a service and returns its DiscoveredService"
+        service = DiscoveredService(name, address, port, fingerprint, seen)
+        old = self._services.get(service.id)
+        if old is not None:
+            service.first_seen = old.first_seen
+            self._index_remove(self._by_fingerprint, old.fingerprint, old.id)
+        self._services[service.id] = service
+        self._index_add(self._by_name, name, service.id)
+        self._index_add(self._by_fingerprint, fingerprint, service.id)
+        if old is None:
+            self.emit('service-added', service)
+        else:
+            self.emit('service-updated', service)
+        return service
+
+    def _remove(self, service_id):
+        service = self._services.pop(service_id)
+        self._index_remove(self._by_name, service.name, service_id)
+        self._index_remove(self._by_fingerprint, service.fingerprint,
+                           service_id)
+        self.emit('service-removed', service)
+        return service
+
+    def remove(self, name):
+        "Removes the services with the name and returns them"
+        ids = list(self._by_name.get(name, ()))
+        return [self._remove(service_id) for service_id in ids]
+
+    def by_name(self, name):
+        "Returns the services with the name"
+        return [self._services[i] for i in self._by_name.get(name, ())]
+
+    def by_fingerprint(self, fingerprint):
+        "Returns the services advertising the fingerprint"
+        return [self._services[i]
+                for i in self._by_fingerprint.get(fingerprint, ())]
+
+    def fingerprints(self):
+        "Returns the fingerprints advertised by the services"
+        return [fpr for fpr in self._by_fingerprint if fpr]
+
+    def touch(self, names, now=None):
+        "Marks the services with the names as seen now"
+        now = now or time.time()
+        for name in names:
+            for service_id in self._by_name.get(name, ()):
+                self._services[service_id].last_seen = now
+
+    def expire(self, max_age, now=None):
+        '''Removes the services which have not been seen for max_age
+        seconds and returns them
+
+        Avahi normally tells us when a service goes away, so this is
+        for cleaning up after the odd missed removal.'''
+        deadline = (now or time.time()) - max_age
+        expired = [service_id for service_id, service in self._services.items()
+                   if service.last_seen < deadline]
+        return [self._remove(service_id) for service_id in expired]
+
+    def __repr__(self):
+        return 'DiscoveredServices(%r)' % list(self._services.values())
@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+#    Copyright 2016 Andrei Macavei <andrei.macavei89@gmail.com>
+#
+#    This file is part of GNOME Keysign.
+#
+#    GNOME Keysign is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    GNOME Keysign is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with GNOME Keysign.  If not, see <http://www.gnu.org/licenses/>.
+"""Downloads keys from the keyservers of other participants
+
+The keyservers are the _keysign._tcp services found by the
+AvahiBrowser.  The downloads and the verification of the
+downloaded data happen in worker threads; the results are
+handed to the main loop with GLib.idle_add.
+
+All keyservers which may have a key are asked at the same time and
+the first one to deliver the right key wins, so a slow, unreachable,
+or malicious participant does not hold up the download.
+"""
+from collections import OrderedDict
+import logging
+from multiprocessing.pool import ThreadPool
+import threading
+
+from gi.repository import GLib
+import requests
+
+from .. import gpgmh
+
+log = logging.getLogger(__name__)
+
+__all__ = ["KeyFetcher", "KeyDownload", "KeyCache", "KeyPrefetcher"]
+
+
+def format_url(address, port, path='/'):
+    "Returns the URL of a keyserver, putting IPv6 addresses in brackets"
+    if ':' in address:
+        # The zone of a link-local address needs its % escaped
+        address = '[%s]' % address.replace('%', '%25')
+    return 'http://{}:{}{}'.format(address, port, path)
+
+
+class DownloadStopped(Exception):
+    "Raised by download_key_http if the download is not wanted anymore"
+
+
+def download_key_http(address, port, timeout=10, session=None, stop=None,
+                      path='/'):
+    '''Returns the data served by the keyserver at address and port
+
+    If stop, a threading.Event, gets set, the download is
+    aborted with DownloadStopped.'''
+    getter = session or requests
+    response = getter.get(format_url(address, port, path), timeout=timeout,
+                          stream=stop is not None)
+    try:
+        response.raise_for_status()
+        if stop is None:
+            return response.content
+        data = bytearray()
+        for chunk in response.iter_content(4096):
+            if stop.is_set():
+                raise DownloadStopped()
+            data += chunk
+        return bytes(data)
+    finally:
+        response.close()
+
+
+def verify_keydata(fingerprint, keydata):
+    '''Returns the Key if keydata is the key with the given fingerprint
+
+    Anyone can publish a service claiming to have any fingerprint,
+    so this is what decides whether downloaded data is used.'''
+    try:
+        fpr = gpgmh.fingerprint_for_key(keydata)
+    except (ValueError, EnvironmentError) as e:
+        log.warning('Could not determine the fingerprint of the data: %s', e)
+        return None
+    if fpr != fingerprint:
+        log.warning('Got the key %s instead of %s', fpr, fingerprint)
+        return None
+    return gpgmh.openpgpkey_from_data(keydata)
+
+
+class KeyDownload(object):
+    '''A download of a key which is running in the background
+
+    Once a keyserver has delivered the key, callback is called with
+    the Key and its data from the main loop.  If none did, error_cb
+    is called without arguments.  After cancel() neither is called.
+
+    The candidates are lists of (address, port) tuples.  The keyservers
+    of a list are asked at the same time, the next list is only tried
+    if none of them had the key.
+    '''
+    def __init__(self, fingerprint, callback, error_cb=None, candidates=()):
+        self.fingerprint = fingerprint
+        self.callback = callback
+        self.error_cb = error_cb
+        self._candidates = [c for c in candidates if c]
+        self._cancelled = threading.Event()
+        # Set once a key has been found or all keyservers have failed,
+        # so that the remaining downloads can stop.
+        self._settled = threading.Event()
+        self._lock = threading.Lock()
+        self._pending = 0
+
+    def cancel(self):
+        self._cancelled.set()
+        self._settled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    @property
+    def settled(self):
+        return self._settled.is_set()
+
+    def _next_candidates(self):
+        '''Returns the next list of keyservers to ask, or None
+        if all have been tried'''
+        with self._lock:
+            if self.settled or not self._candidates:
+                self._settled.set()
+                return None
+            candidates = self._candidates.pop(0)
+            self._pending = len(candidates)
+            return candidates
+
+    def _finished_one(self, key, keydata):
+        '''Is called by the workers when a keyserver has been asked.
+        Returns whether the next candidates should be asked.'''
+        with self._lock:
+            self._pending -= 1
+            if self.settled:
+                return False
+            if key is not None:
+                self._settled.set()
+                GLib.idle_add(self._succeed, key, keydata)
+                return False
+            return self._pending == 0
+
+    def _succeed(self, key, keydata):
+        if not self.cancelled:
+            self.callback(key, keydata)
+        return False
+
+    def _fail(self):
+        if not self.cancelled and self.error_cb:
+            self.error_cb()
+        return False
+
+
+class KeyFetcher(object):
+    '''Downloads keys from the discovered keyservers on a pool
+    of worker threads, so that the main loop never waits for
+    the network or for gpg.
+
+    The pool should be big enough to ask all keyservers
+    advertising a fingerprint at the same time.
+    '''
+    def __init__(self, max_workers=16, timeout=10):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self._pool = None
+        self._local = threading.local()
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            self._pool = ThreadPool(self.max_workers)
+        return self._pool
+
+    def _session(self):
+        "Returns the requests Session of the current worker thread"
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def candidates(self, fingerprint, services, fallback=True):
+        '''Returns the lists of (address, port) of the services to try
+
+        The services are the DiscoveredServices of the Application.
+        Those which advertise the fingerprint are asked first.  The
+        others are only asked if none of them has the key, and
+        only if fallback is set.'''
+        advertising = [(s.address, s.port)
+                       for s in services.by_fingerprint(fingerprint)]
+        if not fallback:
+            return [advertising]
+        others = [(s.address, s.port)
+                  for s in services if s.fingerprint != fingerprint]
+        return [advertising, others]
+
+    def fetch(self, fingerprint, services, callback, error_cb=None,
+              fallback=True):
+        '''Starts downloading the key with the fingerprint from the
+        services and returns the KeyDownload'''
+        candidates = self.candidates(fingerprint, services, fallback)
+        download = KeyDownload(fingerprint, callback, error_cb, candidates)
+        log.debug('Fetching %s from %s', fingerprint, candidates)
+        self._ask_next(download)
+        return download
+
+    def _ask_next(self, download):
+        "Asks the next list of keyservers at the same time"
+        candidates = download._next_candidates()
+        if candidates is None:
+            GLib.idle_add(download._fail)
+            return
+        for address, port in candidates:
+            self.pool.apply_async(self._fetch_from,
+                                  (download, address, port))
+
+    def _fetch_from(self, download, address, port):
+        "Runs in a worker thread and asks one keyserver"
+        key = keydata = None
+        try:
+            if not download.settled:
+                # A keyserver may serve several keys
+                path = '/keys/%s' % download.fingerprint
+                keydata = download_key_http(address, port, self.timeout,
+                                            self._session(),
+                                            download._settled, path)
+            # Another keyserver might have been quicker in the meantime,
+            # so we can save running gpg on the data.
+            if keydata is not None and not download.settled:
+                key = verify_keydata(download.fingerprint, keydata)
+        except DownloadStopped:
+            log.debug('Stopped downloading from %s:%s', address, port)
+        except requests.exceptions.RequestException as e:
+            log.info('Could not download from %s:%s: %s', address, port, e)
+        except Exception:
+            log.exception('Fetching %s from %s:%s failed',
+                          download.fingerprint, address, port)
+
+        if download._finished_one(key, keydata):
+            self._ask_next(download)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+
+
+class KeyCache(object):
+    '''Holds the most recently used (key, keydata) tuples
+    by fingerprint, dropping the least recently used ones
+    once there are more than size'''
+    def __init__(self, size=64):
+        self.size = size
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, fingerprint):
+        return fingerprint in self._entries
+
+    def get(self, fingerprint):
+        "Returns the (key, keydata) tuple for the fingerprint or None"
+        entry = self._entries.pop(fingerprint, None)
+        if entry is not None:
+            self._entries[fingerprint] = entry
+        return entry
+
+    def put(self, fingerprint, key, keydata):
+        self._entries.pop(fingerprint, None)
+        self._entries[fingerprint] = (key, keydata)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+
+class KeyPrefetcher(object):
+    '''Downloads the keys of the discovered services before they are asked for
+
+    While enabled, the key advertised by each new service is fetched
+    from that service and, if it has the advertised fingerprint, kept
+    in a KeyCache.  Once the user enters the fingerprint, the key is
+    usually there already.  The prefetching has a fetcher of its own,
+    so it does not compete with the downloads the user waits for.
+    '''
+    def __init__(self, services, cache_size=64, max_workers=2):
+        self.services = services
+        self.cache = KeyCache(cache_size)
+        self.fetcher = KeyFetcher(max_workers=max_workers)
+        # The running KeyDownloads by fingerprint
+        self._downloads = {}
+        self._handlers = []
+
+    @property
+    def enabled(self):
+        return bool(self._handlers)
+
+    def set_enabled(self, enabled):
+        if enabled == self.enabled:
+            return
+        if enabled:
+            self._handlers = [
+                self.services.connect('service-added', self.on_service),
+                self.services.connect('service-updated', self.on_service),
+            ]
+            for fingerprint in self.services.fingerprints():
+                self.prefetch(fingerprint)
+        else:
+            for handler in self._handlers:
+                self.services.disconnect(handler)
+            self._handlers = []
+            for download in self._downloads.values():
+                download.cancel()
+            self._downloads.clear()
+
+    def on_service(self, services, service):
+        if service.fingerprint:
+            self.prefetch(service.fingerprint)
+
+    def prefetch(self, fingerprint):
+        "Starts fetching the key, unless we have or are fetching it already"
+        if fingerprint in self.cache or fingerprint in self._downloads:
+            return
+        log.debug('Prefetching %s', fingerprint)
+        def on_fetched(key, keydata):
+            del self._downloads[fingerprint]
+            self.cache.put(fingerprint, key, keydata)
+        def on_failed():
+            del self._downloads[fingerprint]
+        # Only the services advertising the fingerprint are asked.
+        # The user may never want the key, so we do not ask everyone.
+        self._downloads[fingerprint] = self.fetcher.fetch(
+            fingerprint, self.services, on_fetched, on_failed, fallback=False)
+
+    def lookup(self, fingerprint):
+        "Returns the prefetched (key, keydata) tuple or None"
+        return self.cache.get(fingerprint)
+
+    def close(self):
+        self.set_enabled(False)
+        self.fetcher.close()
@@ -24,39 +24,543 @@ try:
 except ImportError:
     from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
     from SocketServer import ThreadingMixIn
+from collections import OrderedDict, deque
+from email.utils import formatdate
+import errno
+import hashlib
 import logging
+import mmap
+import os
+import select
 import socket
-from threading import Thread
+import tempfile
+from threading import Event, Lock, Thread
+import time
+import zlib
 
 # This is probably really bad...  But doing relative imports only
 # works for modules.  However, I want to be able to call this Keyserver.py
 # for testing purposes.
 # from __init__ import __version__
 from .AvahiPublisher import AvahiPublisher
+from .. import openpgp
 
 log = logging.getLogger(__name__)
 
+
+def gzip_compress(data):
+    "Returns data gzip compressed, in the same way every time"
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def accepts_gzip(accept_encoding):
+    "Returns whether the Accept-Encoding header value allows gzip"
+    for coding in (accept_encoding or '').split(','):
+        params = coding.strip().split(';')
+        if params[0].strip().lower() not in ('gzip', 'x-gzip'):
+            continue
+        for param in params[1:]:
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+
+def etag_matches(if_none_match, etag):
+    "Returns whether the If-None-Match header value matches the etag"
+    for tag in (if_none_match or '').split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == '*' or tag == etag:
+            return True
+    return False
+
+
+def parse_range(range_header, length):
+    '''Returns the (start, end) of the bytes the Range header value
+    asks for, None if the whole body is to be sent, or False if the
+    range cannot be satisfied.  end is exclusive.
+
+    Only single ranges are supported.  Several ranges would need
+    a multipart response, so the whole body is sent instead.'''
+    unit, _, ranges = (range_header or '').partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in ranges:
+        return None
+    first, dash, last = ranges.strip().partition('-')
+    try:
+        if not dash:
+            return None
+        if not first:
+            suffix = int(last)
+            if suffix <= 0:
+                return False
+            return max(length - suffix, 0), length
+        start = int(first)
+        end = int(last) + 1 if last else length
+    except ValueError:
+        return None
+    if start >= length:
+        return False
+    if end <= start:
+        return None
+    return start, min(end, length)
+
+
+def spool_directory():
+    "Returns a directory on a tmpfs to spool keys to, or None"
+    for directory in (os.environ.get('XDG_RUNTIME_DIR'), '/dev/shm'):
+        if (directory and os.path.isdir(directory)
+                and os.access(directory, os.W_OK)):
+            return directory
+    return None
+
+
+class KeyBody(object):
+    '''The body of a response, kept in memory'''
+    def __init__(self, data):
+        self.data = data
+        self._view = memoryview(data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def view(self, start, end):
+        "Returns the bytes from start to end without copying them"
+        return self._view[start:end]
+
+    def send(self, sock, start, end):
+        "Sends some of the bytes from start to end and returns how many"
+        return sock.send(self.view(start, end))
+
+    def close(self):
+        "Releases the body; there is nothing to do for one in memory"
+        pass
+
+
+class SpooledKeyBody(KeyBody):
+    '''The body of a response, spooled to an unlinked file
+
+    The file is mapped into memory, so that the body is served from
+    the page cache rather than from a Python string.  Where there is
+    os.sendfile, the kernel copies the data to the socket directly.
+
+    Once closed, sending fails with EBADF, so that the downloads
+    still in progress are dropped.  A send which is under way in
+    another thread finishes first, and then the file is closed.
+    '''
+    def __init__(self, data, directory=None):
+        self.file = tempfile.TemporaryFile(prefix='keysign-', dir=directory)
+        self.file.write(data)
+        self.file.flush()
+        self.size = len(data)
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.closed = False
+        self._sending = 0
+        self._lock = Lock()
+
+    def __len__(self):
+        return self.size
+
+    def _check_open(self):
+        if self.closed:
+            raise IOError(errno.EBADF, 'The key is not served anymore')
+
+    def view(self, start, end):
+        self._check_open()
+        try:
+            return memoryview(self.map)[start:end]
+        except TypeError:
+            # Python 2's mmap does not support memoryview
+            return buffer(self.map, start, end - start)
+
+    def send(self, sock, start, end):
+        with self._lock:
+            self._check_open()
+            self._sending += 1
+        try:
+            if hasattr(os, 'sendfile'):
+                return os.sendfile(sock.fileno(), self.file.fileno(),
+                                   start, end - start)
+            return sock.send(self.view(start, end))
+        finally:
+            with self._lock:
+                self._sending -= 1
+                if self.closed and not self._sending:
+                    self._release()
+
+    def close(self):
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            if not self._sending:
+                self._release()
+
+    def _release(self):
+        try:
+            self.map.close()
+        except BufferError:
+            # A view is still around; the map is closed along with it
+            pass
+        self.file.close()
+
+
+class BodyRange(object):
+    '''The part of a KeyBody which is still to be sent'''
+    __slots__ = ('body', 'start', 'end')
+
+    def __init__(self, body, start, end):
+        self.body = body
+        self.start = start
+        self.end = end
+
+    def __len__(self):
+        return self.end - self.start
+
+    def send(self, sock):
+        "Sends some of the range and returns how many bytes"
+        sent = self.body.send(sock, self.start, self.end)
+        self.start += sent
+        return sent
+
+    def sendall(self, sock):
+        "Sends the range on a blocking socket"
+        while self.start < self.end:
+            if not self.send(sock):
+                raise IOError('Could not send the body')
+
+    def tobytes(self):
+        return bytes(self.body.view(self.start, self.end))
+
+
+class KeyResponse(object):
+    '''The prepared responses for one variant of a key'''
+    __slots__ = ('etag', 'body', 'protocol', 'headers', 'head',
+                 'not_modified', 'unsatisfiable')
+
+    def __init__(self, etag, body, protocol, headers):
+        self.etag = etag
+        self.body = body
+        self.protocol = protocol
+        self.headers = headers
+        self.head = self._head('200 OK', ['Content-Length: %d' % len(body)])
+        self.not_modified = self._head('304 Not Modified')
+        self.unsatisfiable = self._head('416 Requested Range Not Satisfiable',
+                                        ['Content-Range: bytes */%d'
+                                         % len(body),
+                                         'Content-Length: 0'])
+
+    def _head(self, status, lines=()):
+        lines = ['%s %s' % (self.protocol, status)] + self.headers + list(lines)
+        return ('\r\n'.join(lines) + '\r\n').encode('latin-1')
+
+    def partial_head(self, start, end):
+        return self._head('206 Partial Content', [
+            'Content-Range: bytes %d-%d/%d' % (start, end - 1, len(self.body)),
+            'Content-Length: %d' % (end - start)])
+
+
+class KeyResponses(object):
+    '''The complete HTTP responses for serving a key
+
+    The status line, headers, and body of each response are built
+    once, so that answering a request means picking the right one
+    and sending it in one go.  Only the Date header is added per
+    request.
+
+    The key is available ASCII armored and binary, either of which
+    may be gzip compressed.  Each of these has its own ETag, made
+    from the fingerprint of the key.
+
+    Bodies of at least spool_size bytes are spooled to a file on a
+    tmpfs, see SpooledKeyBody.  Parts of a body can be requested
+    with the Range header, so that big downloads can be resumed.
+    '''
+    spool_size = 256 * 1024
+
+    def __init__(self, keydata, fingerprint=None,
+                 ctype='application/openpgpkey', server='Geysign',
+                 protocol='HTTP/1.0'):
+        if not isinstance(keydata, bytes):
+            keydata = keydata.encode('utf-8')
+        if openpgp.is_armored(keydata):
+            armored = keydata
+            try:
+                binary = openpgp.dearmor(keydata)
+            except openpgp.PacketError as e:
+                log.warning('Not serving the key in binary: %s', e)
+                binary = None
+        else:
+            binary = keydata
+            armored = openpgp.enarmor(keydata).encode('ascii')
+
+        if not fingerprint:
+            try:
+                fingerprint = openpgp.fingerprint(binary or armored)
+            except openpgp.PacketError:
+                fingerprint = hashlib.sha1(keydata).hexdigest().upper()
+        self.fingerprint = fingerprint
+        self.ctype = ctype
+        self.server = server
+        self.protocol = protocol
+
+        # Maps (variant, gzipped) to the KeyResponse
+        self._responses = {}
+        for variant, body in (('armored', armored), ('binary', binary)):
+            if body is None:
+                continue
+            self._add(variant, False, body)
+            compressed = gzip_compress(body)
+            if len(compressed) < len(body):
+                self._add(variant, True, compressed)
+
+        self._date = (None, b'')
+
+    def _add(self, variant, gzipped, body):
+        etag = '"%s%s%s"' % (self.fingerprint,
+                             '.gpg' if variant == 'binary' else '',
+                             '-gzip' if gzipped else '')
+        headers = [
+            ('Server', self.server),
+            ('Content-Type', self.ctype),
+            ('ETag', etag),
+            ('Vary', 'Accept-Encoding'),
+            ('Accept-Ranges', 'bytes'),
+        ]
+        if gzipped:
+            headers.append(('Content-Encoding', 'gzip'))
+        if len(body) >= self.spool_size:
+            body = SpooledKeyBody(body, spool_directory())
+        else:
+            body = KeyBody(body)
+        self._responses[(variant, gzipped)] = KeyResponse(
+            etag, body, self.protocol,
+            ['%s: %s' % header for header in headers])
+
+    def _date_header(self):
+        "Returns the Date header line, which changes once per second"
+        now = int(time.time())
+        if self._date[0] != now:
+            date = 'Date: %s\r\n' % formatdate(now, usegmt=True)
+            self._date = (now, date.encode('latin-1'))
+        return self._date[1]
+
+    def has_variant(self, variant):
+        return (variant, False) in self._responses
+
+    def close(self):
+        "Releases the bodies, e.g. the spooled files"
+        for response in self._responses.values():
+            response.body.close()
+
+    def response_parts(self, variant, accept_encoding=None,
+                       if_none_match=None, head_only=False,
+                       range_header=None, if_range=None, headers=b''):
+        '''Returns the (code, head, body) of the response for a request
+        or None if the variant is not available
+
+        The body is a BodyRange of the body shared by all responses,
+        so it is not copied.  It is None if there is no body to send.
+        The given headers, i.e. complete header lines, are added to
+        the head.'''
+        response = None
+        if accepts_gzip(accept_encoding):
+            response = self._responses.get((variant, True))
+        if response is None:
+            response = self._responses.get((variant, False))
+        if response is None:
+            return None
+
+        tail = self._date_header() + headers + b'\r\n'
+        if etag_matches(if_none_match, response.etag):
+            return 304, response.not_modified + tail, None
+
+        body = response.body
+        byte_range = None
+        # The range only applies if the client still has the same data
+        if range_header and (not if_range
+                             or if_range.strip() == response.etag):
+            byte_range = parse_range(range_header, len(body))
+        if byte_range is False:
+            return 416, response.unsatisfiable + tail, None
+        if byte_range is None:
+            code, head, start, end = 200, response.head, 0, len(body)
+        else:
+            start, end = byte_range
+            code, head = 206, response.partial_head(start, end)
+
+        if head_only:
+            return code, head + tail, None
+        return code, head + tail, BodyRange(body, start, end)
+
+    def response(self, variant, accept_encoding=None, if_none_match=None,
+                 head_only=False, range_header=None, if_range=None):
+        '''Returns the (code, bytes) of the response for a request
+        or None if the variant is not available'''
+        parts = self.response_parts(variant, accept_encoding, if_none_match,
+                                    head_only, range_header, if_range)
+        if parts is None:
+            return None
+        code, head, body = parts
+        return code, head + body.tobytes() if body is not None else head
+
+
+class KeyIndex(object):
+    '''The KeyResponses of the keys a keyserver serves, by fingerprint
+
+    The key added last is the default key, i.e. the one served on /.
+    Keys can be added and removed while the keyserver is running.
+    '''
+    def __init__(self):
+        self._keys = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, fingerprint):
+        return fingerprint in self._keys
+
+    def add(self, responses):
+        with self._lock:
+            previous = self._keys.pop(responses.fingerprint, None)
+            self._keys[responses.fingerprint] = responses
+        if previous is not None and previous is not responses:
+            previous.close()
+
+    def remove(self, fingerprint):
+        with self._lock:
+            responses = self._keys.pop(fingerprint, None)
+        if responses is not None:
+            responses.close()
+        return responses
+
+    def close(self):
+        "Removes all keys"
+        with self._lock:
+            keys = list(self._keys.values())
+            self._keys.clear()
+        for responses in keys:
+            responses.close()
+
+    def get(self, fingerprint=None):
+        '''Returns the KeyResponses for the fingerprint, or
+        for the default key if fingerprint is None'''
+        with self._lock:
+            if fingerprint is not None:
+                return self._keys.get(fingerprint)
+            if self._keys:
+                return next(reversed(self._keys.values()))
+            return None
+
+    def fingerprints(self):
+        with self._lock:
+            return list(self._keys)
+
+
 class KeyRequestHandlerBase(BaseHTTPRequestHandler):
     '''This is the "base class" which needs to be given access
     to the key to be served. So you will not use this class,
     but create a use one inheriting from this class. The subclass
-    must also define a keydata field.
+    must also define a keydata field or, better, a key_responses
+    field made with build_responses, or a key_index to serve
+    several keys.
     '''
     server_version = 'Geysign/' + 'FIXME-Version'
+    # The head and the body of a response are sent separately
+    disable_nagle_algorithm = True
 
     ctype = 'application/openpgpkey' # FIXME: What the mimetype of an OpenPGP key?
 
+    # The paths the default key is served on, and in which variant.
+    # Each key is also served on /keys/<fingerprint>, with .asc or
+    # .gpg appended to get a specific variant.
+    paths = {
+        '/': 'armored',
+        '/key.asc': 'armored',
+        '/key.gpg': 'binary',
+    }
+    keys_path = '/keys/'
+    suffixes = {
+        '.asc': 'armored',
+        '.gpg': 'binary',
+    }
+
+    key_responses = None
+    key_index = None
+
+    @classmethod
+    def build_responses(cls, keydata, fingerprint=None):
+        "Returns the KeyResponses for serving keydata with this class"
+        return KeyResponses(keydata, fingerprint, cls.ctype,
+                            cls.server_version + ' ' + cls.sys_version,
+                            cls.protocol_version)
+
+    @classmethod
+    def get_responses(cls, fingerprint=None):
+        '''Returns the KeyResponses for the fingerprint, or for
+        the default key if fingerprint is None'''
+        if cls.key_index is not None:
+            return cls.key_index.get(fingerprint)
+        if cls.key_responses is None:
+            cls.key_responses = cls.build_responses(cls.keydata)
+        if fingerprint not in (None, cls.key_responses.fingerprint):
+            return None
+        return cls.key_responses
+
+    @classmethod
+    def route(cls, path):
+        '''Returns the fingerprint (None for the default key)
+        and the variant to serve for the path, or None'''
+        path = path.split('?', 1)[0]
+        variant = cls.paths.get(path)
+        if variant is not None:
+            return None, variant
+        if path.startswith(cls.keys_path):
+            fingerprint = path[len(cls.keys_path):]
+            variant = 'armored'
+            for suffix, suffix_variant in cls.suffixes.items():
+                if fingerprint.endswith(suffix):
+                    fingerprint = fingerprint[:-len(suffix)]
+                    variant = suffix_variant
+                    break
+            return fingerprint.upper(), variant
+        return None
+
     def do_GET(self):
-        f = self.send_head(self.keydata)
-        self.wfile.write(self.keydata)
+        self.send_key()
 
-    def send_head(self, keydata=None):
-        kd = keydata if keydata else self.keydata
-        self.send_response(200)
-        self.send_header('Content-Type', self.ctype)
-        self.send_header('Content-Length', len(kd))
-        self.end_headers()
-        return kd
+    def do_HEAD(self):
+        self.send_key(head_only=True)
+
+    def send_key(self, head_only=False):
+        route = self.route(self.path)
+        responses = self.get_responses(route[0]) if route else None
+        parts = None
+        if responses is not None:
+            parts = responses.response_parts(
+                route[1],
+                self.headers.get('Accept-Encoding'),
+                self.headers.get('If-None-Match'),
+                head_only,
+                self.headers.get('Range'),
+                self.headers.get('If-Range'))
+        if parts is None:
+            self.send_error(404)
+            return
+
+        code, head, body = parts
+        self.log_request(code, len(body) if body is not None else '-')
+        self.wfile.flush()
+        self.connection.sendall(head)
+        if body is not None:
+            body.sendall(self.connection)
 
 class ThreadedKeyserver(ThreadingMixIn, HTTPServer):
     '''The keyserver in a threaded fashion'''
@@ -77,14 +581,413 @@ class ThreadedKeyserver(ThreadingMixIn, HTTPServer):
             HTTPServer.server_bind(self)
 
 
+# The errors which only mean that a socket is not ready
+WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+
+class Poller(object):
+    '''Waits for file descriptors to become readable or writable
+
+    This uses poll, or select where there is no poll.  The interest
+    in a file descriptor is only changed if it is different, so that
+    idle connections do not cost anything.
+    '''
+    READ = 1
+    WRITE = 2
+
+    def __init__(self):
+        self._masks = {}
+        self._poll = select.poll() if hasattr(select, 'poll') else None
+
+    def set(self, fd, readable, writable):
+        mask = (self.READ if readable else 0) | (self.WRITE if writable else 0)
+        if self._masks.get(fd, 0) == mask:
+            return
+        if not mask:
+            self.unregister(fd)
+            return
+        self._masks[fd] = mask
+        if self._poll is not None:
+            events = ((select.POLLIN if readable else 0)
+                      | (select.POLLOUT if writable else 0))
+            self._poll.register(fd, events)
+
+    def unregister(self, fd):
+        if self._masks.pop(fd, None) is not None and self._poll is not None:
+            self._poll.unregister(fd)
+
+    def poll(self, timeout):
+        '''Returns the list of (fd, readable, writable) tuples
+        of the file descriptors which are ready'''
+        try:
+            if self._poll is not None:
+                ready = []
+                for fd, events in self._poll.poll(timeout * 1000):
+                    # Errors and hangups are found by reading or writing
+                    failed = events & (select.POLLERR | select.POLLHUP
+                                       | select.POLLNVAL)
+                    ready.append((fd, bool(events & select.POLLIN or failed),
+                                  bool(events & select.POLLOUT or failed)))
+                return ready
+            readers = [fd for fd, m in self._masks.items() if m & self.READ]
+            writers = [fd for fd, m in self._masks.items() if m & self.WRITE]
+            readers, writers, _ = select.select(readers, writers, [], timeout)
+        except (select.error, EnvironmentError) as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+        writers = set(writers)
+        ready = [(fd, True, fd in writers) for fd in readers]
+        ready += [(fd, False, True) for fd in writers.difference(readers)]
+        return ready
+
+
+class KeyserverConnection(object):
+    '''A client connection of the EventKeyserver'''
+    __slots__ = ('socket', 'fd', 'address', 'inbuf', 'outbuf', 'keep_alive',
+                 'last_active', 'closed')
+
+    def __init__(self, sock, address):
+        self.socket = sock
+        self.fd = sock.fileno()
+        self.address = address
+        self.inbuf = bytearray()
+        # memoryviews of the heads and BodyRanges of the bodies still
+        # to be sent.  The bodies are those of the KeyResponses, so
+        # they are not copied.
+        self.outbuf = deque()
+        self.keep_alive = True
+        self.last_active = time.time()
+        self.closed = False
+
+
+class EventKeyserver(object):
+    '''The keyserver with all connections handled by a single thread
+
+    It has the serve_forever, shutdown, and server_close methods of
+    the SocketServer classes, so it can replace the ThreadedKeyserver.
+    Instead of a thread and a handler instance per request, it reads
+    the requests of all connections as they come and sends the
+    prepared responses of the handler class.  Connections are kept
+    alive, so a client can download several keys over the same one.
+    At most max_connections are accepted at a time, the others wait
+    in the backlog, and a connection is closed after having been
+    idle for timeout seconds.
+
+    Only GET and HEAD are supported, which is all a keyserver needs.
+    '''
+    address_family = socket.AF_INET6
+    request_queue_size = 64
+    # Requests with longer headers are rejected
+    max_request_size = 8192
+    recv_size = 65536
+
+    def __init__(self, server_address, RequestHandlerClass,
+                 max_connections=64, timeout=10):
+        self.RequestHandlerClass = RequestHandlerClass
+        self.max_connections = max_connections
+        self.timeout = timeout
+
+        self.socket = socket.socket(self.address_family, socket.SOCK_STREAM)
+        try:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            # We want to listen to both IPv4 and IPv6!
+            self.socket.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY,
+                                   False)
+            self.socket.bind(server_address)
+            self.socket.listen(self.request_queue_size)
+        except socket.error:
+            self.socket.close()
+            raise
+        self.socket.setblocking(False)
+        self.server_address = self.socket.getsockname()
+
+        # shutdown() writes to the pipe to wake up serve_forever
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        for fd in (self._wakeup_read, self._wakeup_write):
+            set_nonblocking(fd)
+        self._poller = Poller()
+        self._poller.set(self._wakeup_read, True, False)
+        self._connections = {}
+        self._shutdown_request = False
+        self._is_shut_down = Event()
+        self._is_shut_down.set()
+        self._closed = False
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def serve_forever(self, poll_interval=0.5):
+        '''Handles the connections until shutdown() is called'''
+        self._is_shut_down.clear()
+        listener = self.socket.fileno()
+        try:
+            while not self._shutdown_request:
+                # Stop accepting while we have too many connections
+                accepting = len(self._connections) < self.max_connections
+                self._poller.set(listener, accepting, False)
+                for fd, readable, writable in self._poller.poll(
+                        min(poll_interval, self.timeout)):
+                    if fd == self._wakeup_read:
+                        self._drain_wakeup()
+                    elif fd == listener:
+                        self._accept()
+                    else:
+                        connection = self._connections.get(fd)
+                        if connection is not None and readable:
+                            self._on_readable(connection)
+                        connection = self._connections.get(fd)
+                        if connection is not None and writable:
+                            self._on_writable(connection)
+                self._expire(time.time() - self.timeout)
+        finally:
+            self._shutdown_request = False
+            self._is_shut_down.set()
+
+    def shutdown(self):
+        '''Stops serve_forever and waits until it has returned.
+        It must be called from another thread.'''
+        self._shutdown_request = True
+        try:
+            os.write(self._wakeup_write, b'x')
+        except EnvironmentError:
+            # The pipe is full, so serve_forever is going to wake up anyway
+            pass
+        self._is_shut_down.wait()
+
+    def server_close(self):
+        '''Closes the listening socket and all connections'''
+        if self._closed:
+            return
+        self._closed = True
+        for connection in list(self._connections.values()):
+            self._close(connection)
+        self.socket.close()
+        os.close(self._wakeup_read)
+        os.close(self._wakeup_write)
+
+    def _drain_wakeup(self):
+        try:
+            while os.read(self._wakeup_read, 512):
+                pass
+        except EnvironmentError:
+            pass
+
+    def _accept(self):
+        while len(self._connections) < self.max_connections:
+            try:
+                sock, address = self.socket.accept()
+            except socket.error as e:
+                if e.args[0] not in WOULD_BLOCK:
+                    log.warning('Could not accept a connection: %s', e)
+                return
+            sock.setblocking(False)
+            # The head and the body of a response are sent separately
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            connection = KeyserverConnection(sock, address)
+            self._connections[connection.fd] = connection
+            self._poller.set(connection.fd, True, False)
+
+    def _close(self, connection):
+        if connection.closed:
+            return
+        connection.closed = True
+        self._poller.unregister(connection.fd)
+        self._connections.pop(connection.fd, None)
+        try:
+            connection.socket.shutdown(socket.SHUT_WR)
+        except socket.error:
+            pass
+        connection.socket.close()
+
+    def _expire(self, deadline):
+        for connection in list(self._connections.values()):
+            if connection.last_active < deadline:
+                log.debug('Closing idle connection from %s',
+                          connection.address[0])
+                self._close(connection)
+
+    def _on_readable(self, connection):
+        try:
+            data = connection.socket.recv(self.recv_size)
+        except socket.error as e:
+            if e.args[0] not in WOULD_BLOCK:
+                self._close(connection)
+            return
+        if not data:
+            self._close(connection)
+            return
+        connection.last_active = time.time()
+        connection.inbuf += data
+        self._process(connection)
+
+    def _on_writable(self, connection):
+        if self._flush(connection):
+            self._process(connection)
+        else:
+            self._update(connection)
+
+    def _process(self, connection):
+        '''Answers the complete requests in the input buffer
+
+        Pipelined requests are answered one after the other, once
+        the response to the previous one has been sent.'''
+        while self._next_request(connection):
+            if not self._flush(connection):
+                break
+        self._update(connection)
+
+    def _next_request(self, connection):
+        '''Queues the response to the next request in the input buffer.
+        Returns False if there is no complete request.'''
+        if connection.outbuf or not connection.keep_alive:
+            return False
+        inbuf = connection.inbuf
+        end = inbuf.find(b'\r\n\r\n', 0, self.max_request_size + 4)
+        if end < 0:
+            if len(inbuf) <= self.max_request_size:
+                return False
+            del inbuf[:]
+            self._respond_error(connection, 400)
+            return True
+        request = bytes(inbuf[:end])
+        del inbuf[:end + 4]
+        self._handle_request(connection, request)
+        return True
+
+    def _flush(self, connection):
+        '''Sends as much of the output buffer as the socket takes.
+        Returns whether everything has been sent.'''
+        outbuf = connection.outbuf
+        while outbuf:
+            data = outbuf[0]
+            try:
+                if isinstance(data, BodyRange):
+                    sent = data.send(connection.socket)
+                else:
+                    sent = connection.socket.send(data)
+            except (socket.error, EnvironmentError) as e:
+                if e.args[0] not in WOULD_BLOCK:
+                    self._close(connection)
+                return False
+            connection.last_active = time.time()
+            if isinstance(data, BodyRange):
+                if data:
+                    return False
+            elif sent < len(data):
+                outbuf[0] = data[sent:]
+                return False
+            outbuf.popleft()
+        return True
+
+    def _update(self, connection):
+        "Waits for what the connection needs next"
+        if connection.closed:
+            return
+        if connection.outbuf:
+            # Not reading while we cannot send saves buffering requests
+            self._poller.set(connection.fd, False, True)
+        elif not connection.keep_alive:
+            self._close(connection)
+        else:
+            self._poller.set(connection.fd, True, False)
+
+    def _connection_headers(self, connection):
+        if connection.keep_alive:
+            return ('Connection: keep-alive\r\n'
+                    'Keep-Alive: timeout=%d\r\n' % self.timeout).encode('ascii')
+        return b'Connection: close\r\n'
+
+    def _handle_request(self, connection, request):
+        lines = request.decode('latin-1').split('\r\n')
+        words = lines[0].split()
+        if len(words) != 3 or not words[2].startswith('HTTP/'):
+            self._respond_error(connection, 400)
+            return
+        method, path, version = words
+
+        headers = {}
+        for line in lines[1:]:
+            name, colon, value = line.partition(':')
+            if not colon:
+                self._respond_error(connection, 400)
+                return
+            headers[name.strip().lower()] = value.strip()
+
+        tokens = headers.get('connection', '').lower()
+        if version == 'HTTP/1.1':
+            connection.keep_alive = 'close' not in tokens
+        else:
+            connection.keep_alive = 'keep-alive' in tokens
+
+        if method not in ('GET', 'HEAD'):
+            # The request might have a body, which we do not read
+            self._respond_error(connection, 501, keep_alive=False)
+            return
+
+        handler = self.RequestHandlerClass
+        route = handler.route(path)
+        responses = handler.get_responses(route[0]) if route else None
+        parts = None
+        if responses is not None:
+            parts = responses.response_parts(
+                route[1],
+                headers.get('accept-encoding'),
+                headers.get('if-none-match'),
+                method == 'HEAD',
+                headers.get('range'),
+                headers.get('if-range'),
+                headers=self._connection_headers(connection))
+        if parts is None:
+            self._respond_error(connection, 404)
+            return
+
+        code, head, body = parts
+        log.info('%s "%s" %d', connection.address[0], lines[0], code)
+        connection.outbuf.append(memoryview(head))
+        if body:
+            connection.outbuf.append(body)
+
+    def _respond_error(self, connection, code, keep_alive=None):
+        if keep_alive is not None:
+            connection.keep_alive = keep_alive
+        if code == 400:
+            # We do not know where the next request starts
+            connection.keep_alive = False
+        reason = BaseHTTPRequestHandler.responses.get(code, ('Error',))[0]
+        log.info('%s error %d', connection.address[0], code)
+        body = ('%d %s\n' % (code, reason)).encode('ascii')
+        head = ('HTTP/1.0 %d %s\r\n'
+                'Content-Type: text/plain\r\n'
+                'Content-Length: %d\r\n' % (code, reason, len(body)))
+        connection.outbuf.append(memoryview(
+            head.encode('ascii') + self._connection_headers(connection)
+            + b'\r\n' + body))
+
+
+def set_nonblocking(fd):
+    try:
+        import fcntl
+    except ImportError:
+        return
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
 
 class ServeKeyThread(Thread):
     '''Serves requests and manages the server in separates threads.
     You can create an object and call start() to let it run.
     If you want to stop serving, call shutdown().
+
+    More keys can be served by the same server and on the same port
+    with add_key.  Each key is published as a service of its own.
+
+    The server is an EventKeyserver unless server_class says otherwise.
     '''
+    server_class = EventKeyserver
 
-    def __init__(self, data, fpr, port=9001, *args, **kwargs):
+    def __init__(self, data=None, fpr=None, port=9001, *args, **kwargs):
         '''Initializes the server to serve the data'''
         self.keydata = data
         self.fpr = fpr
@@ -92,6 +995,8 @@ class ServeKeyThread(Thread):
         super(ServeKeyThread, self).__init__(*args, **kwargs)
         self.daemon = True
         self.httpd = None
+        self.avahi_publisher = None
+        self.key_index = KeyIndex()
 
 
     def start(self, data=None, fpr=None, port=None, *args, **kwargs):
@@ -107,56 +1012,90 @@ class ServeKeyThread(Thread):
         port = port or self.port or 9001
         fpr = fpr or self.fpr
 
-        tries = 10
-
         kd = data if data else self.keydata
 
+        index = self.key_index
         class KeyRequestHandler(KeyRequestHandlerBase):
             '''You will need to create this during runtime'''
-            keydata = kd
+            key_index = index
         HandlerClass = KeyRequestHandler
 
-        for port_i in (port + p for p in range(tries)):
+        self.httpd = self.bind_server(HandlerClass, port, **kwargs)
+        self.port = self.httpd.server_address[1]
+        log.info('Listening on port %d', self.port)
+
+        # One publisher, and one entry group, for all the keys we are
+        # going to serve.  The services for the keys are added by
+        # add_key, so presenting a key only needs to update the group.
+        if self.avahi_publisher is None:
             try:
-                log.info('Trying port %d', port_i)
-                server_address = ('', port_i)
-                self.httpd = ThreadedKeyserver(server_address, HandlerClass, **kwargs)
-
-                ###
-                # This is a bit of a hack, it really should be
-                # in some lower layer, such as the place were
-                # the socket is created and listen()ed on.
-                service_txt = {
-                    'fingerprint': fpr,
-                    'version': '0.1', #FIXME replace with __version__
-                }
-
-
-                log.info('Requesting Avahi with txt: %s', service_txt)
-
-                self.avahi_publisher = ap = AvahiPublisher(
-                    service_port = port_i,
-                    service_name = 'HTTP Keyserver %s' % fpr,
-                    service_txt = service_txt,
+                publisher = AvahiPublisher(
+                    service_port = self.port,
+                    service_name = None,
                     # self.keydata is too big for Avahi; it chrashes
                     service_type = '_keysign._tcp',
                 )
-                log.info('Trying to add Avahi Service')
-                ap.add_service()
+                publisher.add_service()
+            except Exception:
+                # Do not keep the port while nobody can find us
+                self.httpd.server_close()
+                self.httpd = None
+                raise
+            self.avahi_publisher = publisher
 
-            except socket.error as value:
-                errno = value.errno
-                if errno == 10054 or errno == 32:
-                    # This seems to be harmless
-                    break
-            else:
-                break
+        # Keys added before we had a publisher
+        for fingerprint in self.key_index.fingerprints():
+            self._publish(fingerprint)
+        if kd:
+            self.add_key(kd, fpr)
 
-            finally:
-                pass
+        super(ServeKeyThread, self).start(*args, **kwargs)
 
 
-        super(ServeKeyThread, self).start(*args, **kwargs)
+    def bind_server(self, HandlerClass, port, **kwargs):
+        '''Returns the server listening on the port or, if it is taken,
+        on a port the kernel picks.  Clients find the port with
+        Avahi, so it does not matter much which one we get.'''
+        try:
+            return self.server_class(('', port), HandlerClass, **kwargs)
+        except socket.error as e:
+            if e.args[0] not in (errno.EADDRINUSE, errno.EACCES):
+                raise
+            log.info('Cannot listen on port %d: %s', port, e)
+        return self.server_class(('', 0), HandlerClass, **kwargs)
+
+    @staticmethod
+    def service_name(fpr):
+        return 'HTTP Keyserver %s' % fpr
+
+    def _publish(self, fpr):
+        service_txt = {
+            'fingerprint': fpr,
+            'version': '0.1', #FIXME replace with __version__
+        }
+        log.info('Requesting Avahi with txt: %s', service_txt)
+        self.avahi_publisher.set_service(self.service_name(fpr), service_txt)
+
+    def add_key(self, data, fpr=None):
+        '''Serves the key data, too, and announces its fingerprint
+
+        Returns the fingerprint of the key.'''
+        responses = KeyRequestHandlerBase.build_responses(data, fpr)
+        fpr = responses.fingerprint
+        self.key_index.add(responses)
+        if self.avahi_publisher is not None:
+            self._publish(fpr)
+        return fpr
+
+    def remove_key(self, fpr):
+        '''Stops serving and announcing the key'''
+        self.key_index.remove(fpr)
+        if self.avahi_publisher is not None:
+            self.avahi_publisher.unset_service(self.service_name(fpr))
+
+    def fingerprints(self):
+        "Returns the fingerprints of the keys being served"
+        return self.key_index.fingerprints()
 
 
     def serve_key(self):
@@ -184,10 +1123,16 @@ class ServeKeyThread(Thread):
 
     def shutdown(self):
         '''Sends shutdown to the underlying httpd'''
-        log.info("Removing Avahi Service")
-        self.avahi_publisher.remove_service()
-        log.info("Shutting down httpd %r", self.httpd)
-        self.httpd.shutdown()
+        if self.avahi_publisher is not None:
+            log.info("Removing Avahi Service")
+            self.avahi_publisher.close()
+        if self.httpd is not None:
+            log.info("Shutting down httpd %r", self.httpd)
+            if self.is_alive():
+                # serve_forever would never tell us it has stopped
+                self.httpd.shutdown()
+            self.httpd.server_close()
+        self.key_index.close()
 
 
 if __name__ == '__main__':
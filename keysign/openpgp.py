@@ -0,0 +1,477 @@
+#!/usr/bin/env python
+#    Copyright 2016 Tobias Mueller <muelli@cryptobitch.de>
+#
+#    This file is part of GNOME Keysign.
+#
+#    GNOME Keysign is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    GNOME Keysign is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with GNOME Keysign.  If not, see <http://www.gnu.org/licenses/>.
+"""A minimal reader and writer for OpenPGP packets as per RFC 4880
+
+It knows just enough to compute the fingerprint of a public key,
+to enumerate its UIDs, and to strip third party signatures off it.
+These operations do not need any secret material, so we do not need
+to import the data into a keyring and run gpg for them.
+
+Note that signatures are *not* verified.  Whatever is shown to the
+user or signed must still go through gpg.
+"""
+import base64
+import binascii
+import hashlib
+import logging
+import re
+from struct import unpack_from
+
+log = logging.getLogger(__name__)
+
+
+# Packet tags
+SIGNATURE = 2
+SECRET_KEY = 5
+PUBLIC_KEY = 6
+SECRET_SUBKEY = 7
+MARKER = 10
+TRUST = 12
+USER_ID = 13
+PUBLIC_SUBKEY = 14
+USER_ATTRIBUTE = 17
+
+# Signature subpacket types
+SUBPACKET_CREATION_TIME = 2
+SUBPACKET_KEY_EXPIRATION_TIME = 9
+SUBPACKET_ISSUER = 16
+SUBPACKET_ISSUER_FINGERPRINT = 33
+
+
+class PacketError(ValueError):
+    "Raised when the data cannot be parsed as OpenPGP packets"
+
+
+def _to_bytes(data):
+    "Returns data as something we can take a memoryview of"
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return data
+    return data.encode('utf-8')
+
+
+def _as_bytes(data):
+    "Returns a bytes copy of data"
+    if isinstance(data, memoryview):
+        # bytes() of a memoryview gives its repr on Python 2
+        return data.tobytes()
+    return bytes(_to_bytes(data))
+
+
+def _native_str(view):
+    '''Returns the UTF-8 encoded bytes as the str type of this Python,
+    i.e. the bytes on Python 2 and decoded text on Python 3'''
+    data = view.tobytes()
+    if str is bytes:
+        return data
+    return data.decode('utf-8', 'replace')
+
+
+def _hex(view):
+    return str(binascii.hexlify(view).decode('ascii')).upper()
+
+
+## ASCII Armor
+
+ARMOR_BEGIN_RE = re.compile(br'-----BEGIN PGP ([A-Z ]+)-----')
+CRC24_INIT = 0xB704CE
+CRC24_POLY = 0x1864CFB
+
+def _crc24_table():
+    table = []
+    for i in range(256):
+        crc = i << 16
+        for _ in range(8):
+            crc <<= 1
+            if crc & 0x1000000:
+                crc ^= CRC24_POLY
+        table.append(crc & 0xFFFFFF)
+    return table
+
+_CRC24_TABLE = _crc24_table()
+
+def crc24(data):
+    "Computes the checksum of the ASCII armor"
+    crc = CRC24_INIT
+    table = _CRC24_TABLE
+    for byte in bytearray(data):
+        crc = ((crc << 8) & 0xFFFFFF) ^ table[((crc >> 16) ^ byte) & 0xFF]
+    return crc
+
+
+def is_armored(data):
+    "Returns whether data looks like an ASCII armored block"
+    return ARMOR_BEGIN_RE.search(_as_bytes(_to_bytes(data)[:1024])) is not None
+
+
+def dearmor(data):
+    '''Returns the binary data of the first ASCII armored block in data
+
+    The checksum is verified if the armor has one.'''
+    data = _as_bytes(data)
+    m = ARMOR_BEGIN_RE.search(data)
+    if not m:
+        raise PacketError("No ASCII armor found")
+
+    lines = iter(data[m.end():].splitlines())
+    # Skip the armor headers, i.e. everything until the first blank line
+    for line in lines:
+        if not line.strip():
+            break
+
+    body = []
+    checksum = None
+    for line in lines:
+        line = line.strip()
+        if line.startswith(b'-----END PGP '):
+            break
+        elif line.startswith(b'=') and len(line) == 5:
+            checksum = line[1:]
+        elif line:
+            body.append(line)
+    else:
+        raise PacketError("ASCII armor is not terminated")
+
+    try:
+        binary = base64.b64decode(b''.join(body))
+    except (TypeError, binascii.Error) as e:
+        raise PacketError("Invalid ASCII armor: %s" % e)
+
+    if checksum is not None:
+        expected = bytearray(base64.b64decode(checksum))
+        expected = (expected[0] << 16) | (expected[1] << 8) | expected[2]
+        if crc24(binary) != expected:
+            raise PacketError("ASCII armor checksum mismatch")
+    return binary
+
+
+def enarmor(data, blocktype='PUBLIC KEY BLOCK'):
+    "Wraps binary data in ASCII armor, the way gpg --armor does"
+    data = _as_bytes(data)
+    encoded = base64.b64encode(data).decode('ascii')
+    lines = [encoded[i:i+64] for i in range(0, len(encoded), 64)]
+    crc = crc24(data)
+    checksum = base64.b64encode(bytearray(
+        [(crc >> 16) & 0xFF, (crc >> 8) & 0xFF, crc & 0xFF])).decode('ascii')
+    armored = '-----BEGIN PGP %s-----\n\n%s\n=%s\n-----END PGP %s-----\n' % (
+        blocktype, '\n'.join(lines), checksum, blocktype)
+    return str(armored)
+
+
+## Packets
+
+class Packet(object):
+    '''An OpenPGP packet
+
+    raw is the whole packet including its header and body just the
+    contents.  Both are memoryviews into the parsed data, so no copies
+    are made.'''
+    __slots__ = ('tag', 'raw', 'body')
+
+    def __init__(self, tag, raw, body):
+        self.tag = tag
+        self.raw = raw
+        self.body = body
+
+    def __repr__(self):
+        return '<Packet tag=%d length=%d>' % (self.tag, len(self.body))
+
+
+def _new_format_length(view, pos):
+    "Returns the body length and the position after the length octets"
+    first, = unpack_from('>B', view, pos)
+    if first < 192:
+        return first, pos + 1
+    elif first < 224:
+        second, = unpack_from('>B', view, pos + 1)
+        return ((first - 192) << 8) + second + 192, pos + 2
+    elif first == 255:
+        length, = unpack_from('>I', view, pos + 1)
+        return length, pos + 5
+    else:
+        # Partial body lengths are only allowed for data packets,
+        # which do not occur in keys.
+        raise PacketError("Unexpected partial body length")
+
+
+def iter_packets(data):
+    '''Iterates over the OpenPGP packets in binary data
+
+    The data is not copied; the packets refer to it.'''
+    view = memoryview(_to_bytes(data))
+    end = len(view)
+    pos = 0
+    try:
+        while pos < end:
+            start = pos
+            ctb, = unpack_from('>B', view, pos)
+            if not ctb & 0x80:
+                raise PacketError("Invalid packet header at offset %d" % pos)
+
+            if ctb & 0x40:
+                # New format packet
+                tag = ctb & 0x3f
+                length, pos = _new_format_length(view, pos + 1)
+            else:
+                # Old format packet
+                tag = (ctb >> 2) & 0x0f
+                length_type = ctb & 0x03
+                if length_type == 0:
+                    length, = unpack_from('>B', view, pos + 1)
+                    pos += 2
+                elif length_type == 1:
+                    length, = unpack_from('>H', view, pos + 1)
+                    pos += 3
+                elif length_type == 2:
+                    length, = unpack_from('>I', view, pos + 1)
+                    pos += 5
+                else:
+                    # Indeterminate length, the packet extends to the end
+                    pos += 1
+                    length = end - pos
+
+            body_start = pos
+            pos += length
+            if pos > end:
+                raise PacketError("Truncated packet at offset %d" % start)
+
+            yield Packet(tag, view[start:pos], view[body_start:pos])
+    except Exception as e:
+        # struct.error if a header is cut short
+        if isinstance(e, PacketError):
+            raise
+        raise PacketError("Cannot parse packet: %s" % e)
+
+
+def _iter_subpackets(view):
+    "Iterates over (type, data) of signature subpackets"
+    pos = 0
+    end = len(view)
+    while pos < end:
+        first, = unpack_from('>B', view, pos)
+        if first < 192:
+            length, pos = first, pos + 1
+        elif first < 255:
+            second, = unpack_from('>B', view, pos + 1)
+            length, pos = ((first - 192) << 8) + second + 192, pos + 2
+        else:
+            length, = unpack_from('>I', view, pos + 1)
+            pos += 5
+        if length < 1 or pos + length > end:
+            raise PacketError("Invalid signature subpacket")
+        subtype, = unpack_from('>B', view, pos)
+        # The high bit marks the subpacket as critical
+        yield subtype & 0x7f, view[pos+1:pos+length]
+        pos += length
+
+
+class Signature(object):
+    "The parts of a signature packet we care about"
+    __slots__ = ('packet', 'version', 'sigtype', 'created', 'issuer',
+                 'issuer_fpr', 'key_expiration')
+
+    def __init__(self, packet):
+        self.packet = packet
+        self.issuer = None
+        self.issuer_fpr = None
+        self.created = None
+        self.key_expiration = None
+
+        body = packet.body
+        try:
+            self.version, = unpack_from('>B', body, 0)
+            if self.version in (2, 3):
+                self.sigtype, self.created = unpack_from('>xxBI', body, 0)
+                self.issuer = _hex(body[7:15])
+            elif self.version == 4:
+                self.sigtype, = unpack_from('>B', body, 1)
+                hashed_len, = unpack_from('>H', body, 4)
+                hashed = body[6:6+hashed_len]
+                unhashed_len, = unpack_from('>H', body, 6 + hashed_len)
+                unhashed_start = 8 + hashed_len
+                unhashed = body[unhashed_start:unhashed_start+unhashed_len]
+                self._parse_subpackets(hashed, hashed=True)
+                self._parse_subpackets(unhashed, hashed=False)
+            else:
+                raise PacketError("Unsupported signature version %d"
+                                  % self.version)
+        except Exception as e:
+            if isinstance(e, PacketError):
+                raise
+            raise PacketError("Cannot parse signature: %s" % e)
+
+    def _parse_subpackets(self, view, hashed):
+        for subtype, data in _iter_subpackets(view):
+            if subtype == SUBPACKET_ISSUER:
+                self.issuer = _hex(data)
+            elif subtype == SUBPACKET_ISSUER_FINGERPRINT:
+                # The first octet is the key version
+                self.issuer_fpr = _hex(data[1:])
+            elif hashed and subtype == SUBPACKET_CREATION_TIME:
+                self.created, = unpack_from('>I', data, 0)
+            elif hashed and subtype == SUBPACKET_KEY_EXPIRATION_TIME:
+                self.key_expiration, = unpack_from('>I', data, 0)
+
+    def is_issued_by(self, fingerprint):
+        "Returns whether the key with the fingerprint made this signature"
+        if self.issuer_fpr is not None:
+            return self.issuer_fpr == fingerprint
+        return self.issuer is not None and fingerprint.endswith(self.issuer)
+
+
+def fingerprint_for_packet(packet):
+    "Computes the v4 fingerprint of a public (sub)key packet"
+    body = packet.body
+    version, = unpack_from('>B', body, 0)
+    if version != 4:
+        raise PacketError("Unsupported key version %d" % version)
+    digest = hashlib.sha1()
+    digest.update(bytearray([0x99, (len(body) >> 8) & 0xFF, len(body) & 0xFF]))
+    digest.update(body)
+    return str(digest.hexdigest()).upper()
+
+
+class TransferableKey(object):
+    '''A public key the way it is exported, i.e. the primary key
+    followed by its UIDs, user attributes, and subkeys
+
+    components is a list of (packet, signatures) tuples with the
+    primary key packet first and the signatures as Signature objects.
+    '''
+    __slots__ = ('components', 'fingerprint')
+
+    def __init__(self, primary):
+        self.components = [(primary, [])]
+        self.fingerprint = fingerprint_for_packet(primary)
+
+    @property
+    def primary(self):
+        return self.components[0][0]
+
+    @property
+    def keyid(self):
+        return self.fingerprint[-16:]
+
+    @property
+    def created(self):
+        created, = unpack_from('>xI', self.primary.body, 0)
+        return created
+
+    @property
+    def uids(self):
+        "The UIDs of the key as strings"
+        return [_native_str(packet.body)
+                for packet, sigs in self.components
+                if packet.tag == USER_ID]
+
+    def self_signatures(self):
+        "Iterates over (packet, signature) for all self-signatures"
+        fpr = self.fingerprint
+        for packet, sigs in self.components:
+            for sig in sigs:
+                if sig.is_issued_by(fpr):
+                    yield packet, sig
+
+    @property
+    def expiry(self):
+        '''The time at which the key expires as seconds since the epoch
+        or None if it does not expire
+
+        It is taken from the newest self-signature over the primary
+        key or a UID.  We do not check the signatures, though.'''
+        newest = None
+        for packet, sig in self.self_signatures():
+            if packet.tag not in (PUBLIC_KEY, USER_ID):
+                continue
+            if newest is None or (sig.created or 0) > (newest.created or 0):
+                newest = sig
+        if newest is None or not newest.key_expiration:
+            return None
+        return self.created + newest.key_expiration
+
+    def to_bytes(self, signature_filter=None):
+        '''Serialises the key
+
+        If signature_filter is given, only the signatures for which
+        it returns True are written.'''
+        out = bytearray()
+        for packet, sigs in self.components:
+            out += packet.raw
+            for sig in sigs:
+                if signature_filter is None or signature_filter(sig):
+                    out += sig.packet.raw
+        return bytes(out)
+
+    def minimal(self):
+        "Serialises the key with the self-signatures only"
+        fpr = self.fingerprint
+        return self.to_bytes(lambda sig: sig.is_issued_by(fpr))
+
+
+def parse_keys(data):
+    '''Parses armored or binary data into a list of TransferableKeys
+
+    Trust and marker packets are skipped.'''
+    if is_armored(data):
+        data = dearmor(data)
+
+    keys = []
+    key = None
+    for packet in iter_packets(data):
+        tag = packet.tag
+        if tag == PUBLIC_KEY:
+            key = TransferableKey(packet)
+            keys.append(key)
+        elif tag in (TRUST, MARKER):
+            continue
+        elif key is None:
+            raise PacketError("Expected a public key packet, got %r" % packet)
+        elif tag in (USER_ID, USER_ATTRIBUTE, PUBLIC_SUBKEY):
+            key.components.append((packet, []))
+        elif tag == SIGNATURE:
+            key.components[-1][1].append(Signature(packet))
+        elif tag in (SECRET_KEY, SECRET_SUBKEY):
+            raise PacketError("Secret keys are not supported")
+        else:
+            log.debug('Ignoring unexpected %r', packet)
+    if not keys:
+        raise PacketError("No public key found")
+    return keys
+
+
+def parse_key(data):
+    "Parses data which must contain exactly one key"
+    keys = parse_keys(data)
+    if len(keys) != 1:
+        raise PacketError("Expected one key, but got %d: %s"
+                          % (len(keys), [k.fingerprint for k in keys]))
+    return keys[0]
+
+
+def fingerprint(data):
+    "Returns the fingerprint of the one key in data"
+    return parse_key(data).fingerprint
+
+
+def minimize(data):
+    '''Strips all but the self-signatures off the one key in data
+
+    The result is armored if data is armored.'''
+    minimal = parse_key(data).minimal()
+    if is_armored(data):
+        return enarmor(minimal)
+    return minimal
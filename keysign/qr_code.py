@@ -16,20 +16,87 @@
 #
 #    You should have received a copy of the GNU General Public License
 #    along with GNOME Keysign.  If not, see <http://www.gnu.org/licenses/>.
+from collections import OrderedDict
 import logging
 
 import gi
 gi.require_version('Gtk', '3.0')
 from gi.repository import Gdk, Gtk, GObject
 import qrcode
+import qrcode.constants
 import cairo
 
+try:
+    import numpy
+except ImportError:
+    # We can do without, only a bit slower
+    numpy = None
+
 log = logging.getLogger(__name__)
 
+
+def matrix_to_a8(matrix, background, foreground, stride):
+    '''Returns the pixels of an A8 image of the QR code matrix, i.e.
+    one byte per module, with stride bytes per row
+
+    Note that we do [y][x], otherwise the generated code is
+    diagonally mirrored.  The dark modules get the background
+    value, which gives us a nice white QR Code.'''
+    size = len(matrix)
+    if numpy is not None:
+        pixels = numpy.zeros((size, stride), dtype=numpy.uint8)
+        pixels[:, :size] = numpy.where(numpy.array(matrix, dtype=bool),
+                                       background, foreground)
+        return bytearray(pixels.tobytes())
+
+    # Each row is converted to bytes of 0 and 1 in one go,
+    # which are then mapped to the pixel values in one go.
+    table = bytearray(range(256))
+    table[0] = foreground
+    table[1] = background
+    table = bytes(table)
+    padding = bytes(bytearray(stride - size))
+    return bytearray(b''.join(bytes(bytearray(row)).translate(table) + padding
+                              for row in matrix))
+
+
+class QRSurfaceCache(object):
+    '''Holds the most recently used QR code surfaces, keyed by
+    (data, error correction, background, foreground), dropping the
+    least recently used ones once there are more than size'''
+    def __init__(self, size=16):
+        self.size = size
+        self._surfaces = OrderedDict()
+
+    def __len__(self):
+        return len(self._surfaces)
+
+    def get(self, key):
+        surface = self._surfaces.pop(key, None)
+        if surface is not None:
+            self._surfaces[key] = surface
+        return surface
+
+    def put(self, key, surface):
+        self._surfaces.pop(key, None)
+        self._surfaces[key] = surface
+        while len(self._surfaces) > self.size:
+            self._surfaces.popitem(last=False)
+
+    def clear(self):
+        self._surfaces.clear()
+
+
+# The surfaces of all QRImages, so that switching back to a code,
+# or showing it fullscreen, does not encode it again
+qr_surface_cache = QRSurfaceCache()
+
+
 class QRImage(Gtk.DrawingArea):
     """An Image encoding data as a QR Code.
     The image tries to scale as big as possible.
     """
+    error_correction = qrcode.constants.ERROR_CORRECT_M
 
     def __init__(self, data='Default String', handle_events=True,
                        background=0xff, *args, **kwargs):
@@ -124,36 +191,24 @@ class QRImage(Gtk.DrawingArea):
         cr.restore()
 
     def create_qrcode(self, data):
+        key = (data, self.error_correction, self.background, self.foreground)
+        surface = qr_surface_cache.get(key)
+        if surface is not None:
+            return surface
+
         log.debug('Encoding %s', data)
-        code = qrcode.QRCode()
+        code = qrcode.QRCode(error_correction=self.error_correction)
 
         code.add_data(data)
 
         matrix = code.get_matrix()
         size = len(matrix)
-        stride = (size + 3) / 4 * 4
-        data = bytearray(stride * size)
-
-        background = self.background
-        foreground = self.foreground
+        stride = cairo.ImageSurface.format_stride_for_width(cairo.FORMAT_A8,
+                                                            size)
+        pixels = matrix_to_a8(matrix, self.background, self.foreground, stride)
 
-        for x in range(size):
-            for y in range(size):
-                # Here we seem to be defining what
-                # is going to be put on the surface.
-                # I don't know what the semantic is,
-                # though. Is 0 black? Or no modification
-                # of the underlying background?
-                # Anyway, this give us a nice white
-                # QR Code.  Note that we do [y][x],
-                # otherwise the generated code is diagonally
-                # mirrored.
-                if matrix[y][x]:
-                    data[x + y * stride] = background
-                else:
-                    data[x + y * stride] = foreground
-
-        surface = cairo.ImageSurface.create_for_data(data, cairo.FORMAT_A8, size, size, stride)
+        surface = cairo.ImageSurface.create_for_data(pixels, cairo.FORMAT_A8, size, size, stride)
+        qr_surface_cache.put(key, surface)
 
         return surface
 
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+#    Copyright 2016 Tobias Mueller <muelli@cryptobitch.de>
+#
+#    This file is part of GNOME Keysign.
+#
+#    GNOME Keysign is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    GNOME Keysign is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with GNOME Keysign.  If not, see <http://www.gnu.org/licenses/>.
+"""A persistent index of who has signed which key
+
+It answers "have I already signed this key?" without running gpg.
+The index is filled from the list-sigs output of the user's keyring
+and from the signatures we make ourselves, which, as they are sent
+to the key owner, never show up in the user's keyring.
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+try:
+    from . import gpgmh
+except (ImportError, ValueError):
+    # We are not imported as part of the keysign package
+    import gpgmh
+
+log = logging.getLogger(__name__)
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS signatures (
+    signer TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    uid TEXT NOT NULL,
+    created INTEGER,
+    PRIMARY KEY (signer, fingerprint, uid)
+);
+CREATE INDEX IF NOT EXISTS signatures_by_fingerprint
+    ON signatures (fingerprint);
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value TEXT
+);
+'''
+
+
+def _text(s):
+    "SQLite wants text rather than the UTF-8 encoded str of Python 2"
+    if isinstance(s, bytes):
+        return s.decode('utf-8', 'replace')
+    return s
+
+
+def default_index_path():
+    "Returns where the index of the user's keyring is stored"
+    cache = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(cache, 'gnome-keysign', 'signatures.sqlite')
+
+
+def iter_signature_records(records):
+    '''Iterates over (signer, fingerprint, uid, created) tuples
+    of the certifications in a list-sigs colon listing
+
+    Signatures on subkeys and on photo IDs are skipped.'''
+    fingerprint = uid = None
+    want_fpr = False
+    for record in records:
+        rtype = record.type
+        if rtype == 'pub':
+            fingerprint = uid = None
+            want_fpr = True
+        elif rtype == 'fpr':
+            # Only the first fpr after a pub belongs to the primary key
+            if want_fpr:
+                fingerprint = record.fingerprint
+                want_fpr = False
+        elif rtype == 'uid':
+            # As in the KeyTable, rather than with gpg's escapes
+            uid = gpgmh.unescape_colon_field(record.uid)
+        elif rtype in ('uat', 'sub'):
+            uid = None
+        elif rtype == 'sig' and fingerprint and uid is not None:
+            created = record.created
+            yield (record.keyid, fingerprint, uid,
+                   int(created) if created.isdigit() else None)
+
+
+class SignatureIndex(object):
+    '''Maps signer key ids to the (fingerprint, uid) they have signed
+    and back
+
+    Key ids are the 16 hex digit long ids gpg lists for signatures.
+    The index is an SQLite database, so lookups do not need to load
+    the whole index.  It can be used from several threads.
+    '''
+    def __init__(self, path=None):
+        self.path = path or default_index_path()
+        if self.path != ':memory:':
+            directory = os.path.dirname(self.path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        with self._lock:
+            self.db.executescript(SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self.db.close()
+
+    def add(self, signatures):
+        '''Adds (signer, fingerprint, uid, created) tuples to the index
+
+        If created is None, the current time is taken.'''
+        now = int(time.time())
+        rows = ((signer.upper(), fingerprint.upper(), _text(uid),
+                 now if created is None else created)
+                for signer, fingerprint, uid, created in signatures)
+        with self._lock:
+            with self.db:
+                self.db.executemany('INSERT OR REPLACE INTO signatures '
+                                    'VALUES (?, ?, ?, ?)', rows)
+
+    def update_from_records(self, records):
+        '''Indexes the signatures of a list-sigs colon listing
+
+        The signatures of the listed keys which are not in the
+        listing anymore are kept, because they might be ones
+        we have made, but which are not in the keyring.'''
+        self.add(iter_signature_records(records))
+
+    def refresh(self, keyring=None, force=False):
+        '''Indexes the signatures of the keys in the user's keyring
+
+        This does nothing if the keyring has not changed since the
+        last refresh, so it is cheap to call it regularly.'''
+        stamp = repr(gpgmh.keyring_stamp())
+        if not force and self._get_meta('keyring_stamp') == stamp:
+            log.debug('Keyring unchanged, not refreshing the index')
+            return False
+
+        if keyring is None:
+            with gpgmh.keyring_pool.keyring() as keyring:
+                return self.refresh(keyring, force=True)
+
+        lines = gpgmh.iter_command_lines(keyring, ['list-sigs'])
+        records = gpgmh.iter_colon_records(lines,
+                                           types=('pub', 'fpr', 'uid',
+                                                  'uat', 'sub', 'sig'))
+        self.update_from_records(records)
+        self._set_meta('keyring_stamp', stamp)
+        log.info('Refreshed signature index %s', self.path)
+        return True
+
+    def signers_of(self, fingerprint):
+        "Returns (signer, uid, created) tuples of the signatures on a key"
+        with self._lock:
+            cursor = self.db.execute('SELECT signer, uid, created '
+                                     'FROM signatures WHERE fingerprint = ?',
+                                     (fingerprint.upper(),))
+            return cursor.fetchall()
+
+    def signed_by(self, keyid):
+        "Returns (fingerprint, uid, created) tuples signed by a key id"
+        with self._lock:
+            cursor = self.db.execute('SELECT fingerprint, uid, created '
+                                     'FROM signatures WHERE signer = ?',
+                                     (keyid.upper(),))
+            return cursor.fetchall()
+
+    def is_signed_by(self, fingerprint, keyids):
+        '''Returns whether any of the key ids has signed the key
+
+        Fingerprints may be passed instead of key ids.'''
+        keyids = [k.upper()[-16:] for k in keyids]
+        if not keyids:
+            return False
+        # We do not use self-signatures as evidence
+        keyids = [k for k in keyids if not fingerprint.upper().endswith(k)]
+        if not keyids:
+            return False
+        query = ('SELECT 1 FROM signatures WHERE fingerprint = ? '
+                 'AND signer IN (%s) LIMIT 1' % ','.join('?' * len(keyids)))
+        with self._lock:
+            cursor = self.db.execute(query, [fingerprint.upper()] + keyids)
+            return cursor.fetchone() is not None
+
+    def _get_meta(self, name):
+        with self._lock:
+            row = self.db.execute('SELECT value FROM meta WHERE name = ?',
+                                  (name,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, name, value):
+        with self._lock:
+            with self.db:
+                self.db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                                (name, value))